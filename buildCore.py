@@ -3,7 +3,9 @@ import pandas as pd
 from datetime import datetime
 import glob
 from collections import Counter
-from joblib import Parallel, delayed, parallel_backend
+from joblib import Parallel, delayed, parallel_backend, cpu_count
+from joblib.externals.loky import get_reusable_executor
+import asyncio
 from os.path import expanduser
 import re
 import requests
@@ -12,15 +14,25 @@ import ciso8601
 import zipfile
 import time
 import shutil
+import json
+import hashlib
+import sqlite3
 import fiona
 import shapely
 import subprocess
-import shapely
+import numpy as np
 import shapely.geometry
 from collections import OrderedDict
+from buildUtils import jobCosts, timedCall
 home = expanduser("~")
 userKey = os.environ.get('USER')
 
+#Release candidate zips live here.  Point gbRemote at a local directory
+#(with the same <ADM>/<ISO>_<ADM>.zip layout) to stand in for the remote.
+remoteRoot = os.environ.get('gbRemote', "remote:releaseCandidates/gbReleaseCandidate_current/")
+if(not remoteRoot.endswith("/")):
+  remoteRoot = remoteRoot + "/"
+
 def geoLog(timestamp, errorType, errorMessage):
   folderPath = home + "/gbRelease/buildLogs/" + timestamp + "/"
   if not os.path.exists(folderPath):
@@ -86,38 +98,31 @@ class geoBoundary:
       else:
         return 0
     
-  def metaCheck(self):
-    self.metaFail = False
+  def metaCheck(self, metaChecks):
+    #metaChecks is this boundary's row from metaFrameCheck; the reference
+    #lists are read once per build rather than once per boundary.
+    self.metaFail = bool(metaChecks["metaFail"])
     #ISO Valid Check
-    validISOList = pd.read_csv(self.home + "/gbRelease/gbRawData/ISO_0_Standards/ISO_3166_1_Alpha_3.csv", encoding="ISO-8859-1")  
-    if(not self.iso in validISOList["Alpha-3code"].values):
+    if(metaChecks["isoInvalid"]):
       self.geoLog("CRITICAL", ("ISO " +
                                self.iso + " is invalid."))
-      self.metaFail = True
-    
+
     #Boundary Type Valid Check
-    if(not self.adm in 
-       ["ADM0", "ADM1", "ADM2", "ADM3", "ADM4", "ADM5"]):
+    if(metaChecks["admInvalid"]):
       self.geoLog("CRITICAL", ("ADM " +
                                self.adm + " is invalid."))
-      self.metaFail = True
-    
+
     #Source Exists Check
-    if((len(self.source1) < 1) and (len(self.source2) < 1)):
+    if(metaChecks["sourceMissing"]):
       self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm +
                                " does not have a valid source for the file origination."))
-      self.metaFail = True
-  
+
     #License Valid Type Check
-    licenses = list(
-    pd.read_csv(self.home + "/gbRelease/gbRawData/gbLicenses.txt", 
-      header=None)[0])
-    if(not (self.license in licenses)):
+    if(metaChecks["licenseInvalid"]):
         self.geoLog("CRITICAL",("ISO " + self.iso + " | " + self.adm +
                                " does not have a valid license."))
-        self.metaFail = True
-  
-  def checkForUpdatesDownload(self, previousCSV):
+
+  def checkForUpdatesDownload(self, previousCSV, remoteFileDiff, downloadFailed=False):
     self.retrieveFail = False
     self.metaChange = False
     #Check if the metadata has changed since the last version
@@ -143,9 +148,9 @@ class geoBoundary:
                                " was not in the last release, so cannot be compared for changes."))
     
     
-    #Check if the file on google drive is different than what
-    #we have local
-    self.remoteFileDiff = True
+    #Whether the file on google drive is different than what we have
+    #local comes from the manifest diff made once at the start of the run.
+    self.remoteFileDiff = remoteFileDiff
     
     #expected path to zip
     zipDir = home + "/gbRelease/gbRawData/currentZips/"
@@ -155,21 +160,6 @@ class geoBoundary:
       self.remoteFileDiff = True
       self.geoLog("INFO",("ISO " + self.iso + " | " + self.adm +
                                " did not have a local file copy. Downloading."))
-    
-    else:
-      rCloneCall = (home + "/libs/rclone -v --drive-impersonate " +
-                    userKey + " check remote:releaseCandidates/"+
-                    "gbReleaseCandidate_current/" + self.adm + "/" +
-                    self.iso + "_" + self.adm + ".zip " + zipDir)
-                    
-      process = subprocess.Popen([rCloneCall], shell=True, 
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      process.wait()
-      output, error = process.communicate()
-
-      if(("0 differences found" in str(error)) and os.path.isfile(os.path.join(zipDir, (self.iso + "_" + self.adm + ".zip")))):
-        #We already have a matching file, so we can skip this download.
-        self.remoteFileDiff = False
         
     if((self.metaChange == True) and (self.remoteFileDiff == False)):
       self.geoLog("WARN",("ISO " + self.iso + " | " + self.adm +
@@ -179,54 +169,46 @@ class geoBoundary:
       self.geoLog("WARN",("ISO " + self.iso + " | " + self.adm +
                                " File changed, but the metadata did not."))
       
+    #The zip itself was fetched by the download stage before this
+    #boundary was dispatched.
     if(self.remoteFileDiff == True):
-      self.geoLog("INFO",("ISO " + self.iso + " | " + self.adm +
-                               " Downloading new copy from remote."))
-    
-      rCloneCall = (home + "/libs/rclone -v --drive-impersonate " +
-                    userKey + " copy remote:releaseCandidates/"+
-                    "gbReleaseCandidate_current/" + self.adm + "/" +
-                    self.iso + "_" + self.adm + ".zip " + zipDir)
-                    
-      dlProcess = subprocess.Popen([rCloneCall], shell=True)
-      dlProcess.wait()
-      
-      if((dlProcess.returncode != 0) or (not os.path.isfile(os.path.join(zipDir, (self.iso + "_" + self.adm + ".zip"))))):
+      if(downloadFailed or (not os.path.isfile(os.path.join(zipDir, (self.iso + "_" + self.adm + ".zip"))))):
         self.geoLog("CRITICAL",("ISO " + self.iso + " | " + self.adm +
                                " did not have a local file copy, and the download failed."))
         self.retrieveFail = True
         return False
+
+      self.geoLog("INFO",("ISO " + self.iso + " | " + self.adm +
+                               " Downloaded new copy from remote."))
     
-    rawUnzipTarget = (self.home + "/gbRelease/gbRawData/current/" + 
+    #The shapefile is read in place from the zip through GDAL's /vsizip/
+    #filesystem; only the fixed output is written under gbRawData/current.
+    boundaryDir = (self.home + "/gbRelease/gbRawData/current/" + 
                              self.iso + "/" + self.adm + "/")
-    if(((self.retrieveFail == False) and (self.remoteFileDiff == True)) or (not os.path.isdir(rawUnzipTarget))):
-      #Delete any old data and unzip the new data
-
-      if(not os.path.isdir((self.home + "/gbRelease/gbRawData/current/" + 
-                             self.iso + "/"))):
-        while True:
-          try:
-            os.mkdir((self.home + "/gbRelease/gbRawData/current/" + 
-                             self.iso + "/"))
-          except:
-            pass
-
-          else:
-            break
-      
-      if(os.path.isdir(rawUnzipTarget)):
-        shutil.rmtree(rawUnzipTarget)
-        os.mkdir(rawUnzipTarget)
-      if(not os.path.isdir(rawUnzipTarget)):
-        os.mkdir(rawUnzipTarget)
-      
-      try:
-        with zipfile.ZipFile(self.zipPath, "r") as zipObj:
-          zipObj.extractall(rawUnzipTarget)
-      except:
-        self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + ": had an invalid zip file."))
-        self.retrieveFail = True
-        return False
+    try:
+      with zipfile.ZipFile(self.zipPath, "r") as zipObj:
+        shpMembers = [n for n in zipObj.namelist() if n.lower().endswith(".shp")]
+    except:
+      self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + ": had an invalid zip file."))
+      self.retrieveFail = True
+      return False
+
+    expected = [n for n in shpMembers if os.path.basename(n) == (self.iso + "_" + self.adm + ".shp")]
+    if(len(expected) == 0 and len(shpMembers) > 0):
+      expected = shpMembers
+      self.geoLog("WARN", ("ISO " + self.iso + " | " + self.adm + ": zip has no " +
+                           self.iso + "_" + self.adm + ".shp; using " + shpMembers[0]))
+    if(len(expected) == 0):
+      self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + ": zip contains no shapefile."))
+      self.retrieveFail = True
+      return False
+    self.shpPath = "/vsizip/" + self.zipPath + "/" + expected[0]
+
+    #Only boundaries the build state marked for rebuilding get here, so
+    #drop the stale fixed output (and anything left over from older
+    #extracting builds) and let shapeCheckBuild regenerate it.
+    if(os.path.isdir(boundaryDir)):
+      shutil.rmtree(boundaryDir, ignore_errors=True)
 
 
   def shapeCheckBuild(self):
@@ -241,12 +223,8 @@ class geoBoundary:
                  self.iso + "/" + self.adm + "/shapeFixes/" + 
                  self.iso + "_" + self.adm + "_fixedInternalTopology.shp")
 
-    shpPath = (self.home + 
-                 "/gbRelease/gbRawData/current/" + 
-                 self.iso + "/" + self.adm + "/" +
-                 self.iso + "_" + self.adm + ".shp")
-    if(not os.path.isdir(correctHome)):
-      os.mkdir(correctHome)
+    shpPath = self.shpPath
+    os.makedirs(correctHome, exist_ok=True)
       
     if(not os.path.isfile(os.path.join(correctHome, (self.iso + "_" + self.adm + "_fixedInternalTopology.shp")))):
       try:
@@ -273,37 +251,50 @@ class geoBoundary:
         self.shapeFail = True
         return 0
 
-      #Shapefile Topology checks  
-      valid = True
-      error = None
-
-      fixed = []
-      for feature in shpFile:
-        try:
-          raw_shape = shapely.geometry.shape(feature['geometry'])
-          valid = raw_shape.is_valid
-        except:
-          self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + ": At least one feature is topologically invalid and cannot be fixed automatically."))
-          self.shapeFail = True
-          return 0
-        if valid:
-          fixed.append(feature)
-        if not valid:
-          fixed_shape = raw_shape.buffer(0)
-          fix_valid = fixed_shape.is_valid
-          if fix_valid and error is None:
-            self.geoLog("WARN", ("ISO " + self.iso + " | " + self.adm + ": At least one feature had a minor topological issue, fixed by shapely buffer=0."))
-            feature["geometry"] = shapely.geometry.mapping(fixed_shape)
-            fixed.append(feature)
-          elif not fix_valid:
-            if error is not None:
-              self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + ":CRITICAL ERROR: An error in the geometry of the file " + shpPath + " exists that we could not automatically fix."))
-              self.shapeFail = True
-              return 0
-            else:
-              self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + "CRITICAL ERROR: A really bad error in the geometry of the file" + shpPath + "exists that we could not automatically fix."))
-              self.shapeFail = True
-              return 0
+      #Shapefile Topology checks
+      #All geometries are validated in one vectorized call; only the invalid
+      #subset is repaired with buffer(0), with make_valid as a last resort.
+      fixed = list(shpFile)
+      try:
+        geoms = np.empty(len(fixed), dtype=object)
+        geoms[:] = [shapely.geometry.shape(feature['geometry']) for feature in fixed]
+        valid = shapely.is_valid(geoms)
+      except:
+        self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + ": At least one feature is topologically invalid and cannot be fixed automatically."))
+        self.shapeFail = True
+        return 0
+
+      invalid = np.flatnonzero(~valid)
+      bufferFixed = np.array([], dtype=int)
+      makeValidFixed = np.array([], dtype=int)
+      if(len(invalid) > 0):
+        repaired = shapely.buffer(geoms[invalid], 0)
+        repairedValid = shapely.is_valid(repaired)
+        geoms[invalid[repairedValid]] = repaired[repairedValid]
+        bufferFixed = invalid[repairedValid]
+
+        residual = invalid[~repairedValid]
+        if(len(residual) > 0):
+          #make_valid can return collections; keep only polygonal results.
+          made = shapely.make_valid(geoms[residual])
+          madeValid = (shapely.is_valid(made) &
+                       np.isin(shapely.get_type_id(made), [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON]))
+          if(not madeValid.all()):
+            self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + ":CRITICAL ERROR: " + str(int((~madeValid).sum())) + " feature(s) in the geometry of the file " + shpPath + " have errors that we could not automatically fix."))
+            self.shapeFail = True
+            return 0
+          geoms[residual] = made
+          makeValidFixed = residual
+
+        for i in np.concatenate([bufferFixed, makeValidFixed]):
+          fixed[i]["geometry"] = shapely.geometry.mapping(geoms[i])
+
+        self.geoLog("WARN", ("ISO " + self.iso + " | " + self.adm + ": " + str(len(invalid)) + " of " + str(len(fixed)) +
+                             " features had minor topological issues; " + str(len(bufferFixed)) + " fixed by shapely buffer=0, " +
+                             str(len(makeValidFixed)) + " fixed by shapely make_valid."))
+        self.geoLog("INFO", ("ISO " + self.iso + " | " + self.adm + ": buffer=0 fixed features " + str(bufferFixed.tolist()) +
+                             "; make_valid fixed features " + str(makeValidFixed.tolist()) + "."))
+
       try:
         #Attribute schema checks and fixes
         #Only doing these in case of a file update.
@@ -323,51 +314,47 @@ class geoBoundary:
 
         if(dictName == None):
           self.geoLog("WARN", ("ISO " + self.iso + " | " + self.adm + ": No name information was found in a validly named column for: " + shpPath))
-          schema["properties"]["shapeName"] = 'str:254'
-        else:
-          #Rename our name field to the schema field.
-          schema["properties"] = OrderedDict([('shapeName', v) if k==dictName else (k,v) for k,v in schema["properties"].items()])
-
 
         if(dictISO == None):
           self.geoLog("WARN", ("ISO " + self.iso + " | " + self.adm + ": No ISO information was found in a validly named column for: " + shpPath))
-          schema["properties"]["shapeISO"] = 'str:10'
-        else:
-          schema["properties"] = OrderedDict([('shapeISO', v) if k==dictISO else (k,v) for k,v in schema["properties"].items()])
-
-        #remove invalid elements
-        for attribute in list (schema['properties'].items()):
-          if(attribute[0] not in ["shapeISO", "shapeName"]):
-            schema['properties'].pop(attribute[0])
-
-        #Add additional schema elements 
-        schema["properties"]["shapeID"] = 'str:10'
-        schema["properties"]["shapeGroup"] = 'str:50'
-        schema["properties"]["shapeType"] = 'str:10'
-
-        #Repeat for ordered dicts representing each feature.
-        year = self.year
-        featureID = 0
-        for elem in fixed:
-          featureID = featureID + 1
-          if(dictName == None):
-            elem["properties"]["shapeName"] = 'None'
-          else:
-            elem["properties"] = OrderedDict([('shapeName', v) if k==dictName else (k,v) for k,v in elem["properties"].items()])
-
-          if(dictISO == None):
-            elem["properties"]["shapeISO"] = 'None'
-          else:
-            elem["properties"] = OrderedDict([('shapeISO', v) if k==dictISO else (k,v) for k,v in elem["properties"].items()])
-
-            #remove invalid elements
-          for attribute in list (elem['properties'].items()):
-            if(attribute[0] not in ["shapeISO", "shapeName"]):
-              elem['properties'].pop(attribute[0])  
-
-          elem["properties"]["shapeID"] = (self.iso + "-" + self.adm + "-" + self.version + '-B' + str(featureID))
-          elem["properties"]["shapeGroup"] = self.iso
-          elem["properties"]["shapeType"] = self.adm
+
+        #The rename, drop and add steps are expressed once as a column
+        #mapping and applied to a columnar table of all feature attributes.
+        columnMap = OrderedDict()
+        for column in schema["properties"]:
+          if(column == dictName):
+            columnMap[column] = "shapeName"
+          if(column == dictISO):
+            columnMap[column] = "shapeISO"
+
+        attributes = pd.DataFrame.from_records([elem["properties"] for elem in fixed],
+                                               columns=list(schema["properties"].keys()))
+        attributes = attributes[list(columnMap.keys())].rename(columns=columnMap)
+        properties = OrderedDict([(columnMap[k], schema["properties"][k]) for k in columnMap])
+
+        if(dictName == None):
+          attributes["shapeName"] = 'None'
+          properties["shapeName"] = 'str:254'
+        if(dictISO == None):
+          attributes["shapeISO"] = 'None'
+          properties["shapeISO"] = 'str:10'
+
+        #Add additional schema elements
+        #The fixed shapefile is kept across incremental nightlies, so its
+        #shapeIDs carry no version; buildReleases stamps the release
+        #version into every shapeID when it writes HPSCU.
+        attributes["shapeID"] = (self.iso + "-" + self.adm + '-B' +
+                                 pd.Series(np.arange(1, len(fixed) + 1), index=attributes.index).astype(str))
+        attributes["shapeGroup"] = self.iso
+        attributes["shapeType"] = self.adm
+        properties["shapeID"] = 'str:50'
+        properties["shapeGroup"] = 'str:50'
+        properties["shapeType"] = 'str:10'
+        schema["properties"] = properties
+
+        attributes = attributes.astype(object).where(attributes.notna(), None)
+        for elem, record in zip(fixed, attributes.to_dict('records')):
+          elem["properties"] = record
       except:
         self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + ": schema could not be corrected."))
         self.shapeFail = True
@@ -376,36 +363,282 @@ class geoBoundary:
       #Update the original file with a corrected version:
       try:
         with fiona.open(corrected_shp, 'w', 'ESRI Shapefile', schema, shpFile.crs) as output:
-          for elem in fixed:
-            output.write(elem)
+          output.writerecords(fixed)
       except:
         self.geoLog("CRITICAL", ("ISO " + self.iso + " | " + self.adm + ": update did not write correctly."))
         self.shapeFail = True
         
-def gbBuild (nightlyVersion, gbMeta, home, previousCSV):
+#Metadata validation shared by every boundary in a build.
+def buildValidationContext(home):
+  #Reference lists used by metaCheck, read once per build.
+  validISOList = pd.read_csv(home + "/gbRelease/gbRawData/ISO_0_Standards/ISO_3166_1_Alpha_3.csv", encoding="ISO-8859-1")
+  licenses = pd.read_csv(home + "/gbRelease/gbRawData/gbLicenses.txt", header=None)[0]
+  return {"iso": frozenset(validISOList["Alpha-3code"].astype(str)),
+          "adm": frozenset(["ADM0", "ADM1", "ADM2", "ADM3", "ADM4", "ADM5"]),
+          "license": frozenset(licenses.astype(str))}
+
+def metaFrameCheck(metaFrame, validationContext):
+  #Runs every metaCheck test over the whole metadata frame at once.
+  #Returns one row per boundary with a boolean column per failed check.
+  iso = metaFrame["Processed File Name"].astype(str).str[:3]
+  adm = metaFrame["Processed File Name"].astype(str).str[4:8]
+  checks = pd.DataFrame(index=metaFrame.index)
+  checks["isoInvalid"] = ~iso.isin(validationContext["iso"])
+  checks["admInvalid"] = ~adm.isin(validationContext["adm"])
+  checks["sourceMissing"] = ((metaFrame["Source 1"].astype(str).str.len() < 1) &
+                             (metaFrame["Source 2"].astype(str).str.len() < 1))
+  checks["licenseInvalid"] = ~metaFrame["License"].astype(str).isin(validationContext["license"])
+  checks["metaFail"] = checks.any(axis=1)
+  return checks
+
+#Remote / local zip manifests.
+#The remote is listed once, with hashes, and compared to a local manifest
+#of currentZips to find exactly which boundaries need downloading.
+def md5File(path, chunkSize=1048576):
+  h = hashlib.md5()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunkSize), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+def remoteManifest(remoteRoot):
+  #Returns {"<ADM>/<ISO>_<ADM>.zip": md5}, or None if the listing failed.
+  if(os.path.isdir(remoteRoot)):
+    manifest = {}
+    for root, dirs, files in os.walk(remoteRoot):
+      for f in files:
+        if(f.endswith(".zip")):
+          fullPath = os.path.join(root, f)
+          manifest[os.path.relpath(fullPath, remoteRoot).replace(os.sep, "/")] = md5File(fullPath)
+    return manifest
+
+  rCloneCall = [home + "/libs/rclone", "lsjson", "-R", "--files-only", "--hash",
+                "--drive-impersonate", str(userKey), remoteRoot]
+  process = subprocess.run(rCloneCall, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  if(process.returncode != 0):
+    return None
+  manifest = {}
+  for entry in json.loads(process.stdout):
+    if(entry["Path"].endswith(".zip")):
+      hashes = dict((k.lower(), v) for k, v in (entry.get("Hashes") or {}).items())
+      manifest[entry["Path"]] = hashes.get("md5")
+  return manifest
+
+def localZipManifest(zipDir):
+  #Returns {"<ISO>_<ADM>.zip": md5}.  Hashes are cached alongside the zips
+  #and only recomputed for files whose size or mtime changed.
+  manifestPath = zipDir + "manifest.json"
+  cached = {}
+  if(os.path.isfile(manifestPath)):
+    try:
+      with open(manifestPath, 'r') as f:
+        cached = json.load(f)
+    except:
+      cached = {}
+
+  entries = {}
+  for f in os.listdir(zipDir):
+    if(not f.endswith(".zip")):
+      continue
+    stat = os.stat(zipDir + f)
+    entry = cached.get(f)
+    if(entry == None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime):
+      entry = {"size": stat.st_size, "mtime": stat.st_mtime, "md5": md5File(zipDir + f)}
+    entries[f] = entry
+
+  with open(manifestPath, 'w') as f:
+    json.dump(entries, f)
+  return dict((f, entries[f]["md5"]) for f in entries)
+
+#Download stage.
+#Every needed zip is fetched from one asyncio loop with a cap on concurrent
+#remote connections, exponential-backoff retries and an md5 check against
+#the remote manifest.  Zips land in a partial folder and are only moved
+#into currentZips once verified.
+downloadConcurrency = int(os.environ.get('gbDownloadConcurrency', 8))
+downloadRetries = int(os.environ.get('gbDownloadRetries', 4))
+
+async def downloadZip(zipName, zipDir, expectedMD5, semaphore, nightlyVersion):
+  adm = zipName[4:8]
+  partialDir = zipDir + ".partial/" + zipName[:-4] + "/"
+  loop = asyncio.get_running_loop()
+  for attempt in range(downloadRetries + 1):
+    if(attempt > 0):
+      await asyncio.sleep(min(2 ** attempt, 60))
+    #Filesystem and transfer errors count as a failed attempt rather than
+    #escaping and taking the rest of the nightly down with them.
+    try:
+      if(os.path.isdir(partialDir)):
+        shutil.rmtree(partialDir)
+      os.makedirs(partialDir)
+
+      async with semaphore:
+        if(os.path.isdir(remoteRoot)):
+          #Local stand-in for the remote.
+          try:
+            await loop.run_in_executor(None, shutil.copy,
+                                       os.path.join(remoteRoot, adm, zipName), partialDir)
+            returncode = 0
+          except:
+            returncode = 1
+        else:
+          dlProcess = await asyncio.create_subprocess_exec(
+            home + "/libs/rclone", "copy", "--drive-impersonate", str(userKey),
+            remoteRoot + adm + "/" + zipName, partialDir,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+          returncode = await dlProcess.wait()
+
+      if((returncode == 0) and os.path.isfile(partialDir + zipName)):
+        md5 = await loop.run_in_executor(None, md5File, partialDir + zipName)
+        if((expectedMD5 == None) or (md5 == expectedMD5)):
+          os.replace(partialDir + zipName, zipDir + zipName)
+          shutil.rmtree(partialDir)
+          return True
+        geoLog(nightlyVersion, "WARN", zipName + " failed its checksum (attempt " + str(attempt + 1) + ").")
+      else:
+        geoLog(nightlyVersion, "WARN", zipName + " failed to download (attempt " + str(attempt + 1) + ").")
+    except Exception as e:
+      geoLog(nightlyVersion, "WARN", zipName + " failed to download (attempt " + str(attempt + 1) + "): " + repr(e))
+
+  shutil.rmtree(partialDir, ignore_errors=True)
+  return False
+
+#Build state store.
+#One row per boundary recording the hashes of the inputs (source zip and
+#metadata row) and the output (fixed shapefile) of its last successful
+#build.  Only the parent process writes to it.
+def openBuildState(path):
+  conn = sqlite3.connect(path)
+  conn.execute("CREATE TABLE IF NOT EXISTS boundaryState (" +
+               "boundary TEXT PRIMARY KEY, sourceHash TEXT, metaHash TEXT, " +
+               "fixedHash TEXT, version TEXT)")
+  return conn
+
+def loadBuildState(path):
+  conn = openBuildState(path)
+  rows = conn.execute("SELECT boundary, sourceHash, metaHash, fixedHash, version FROM boundaryState").fetchall()
+  conn.close()
+  return dict((r[0], {"sourceHash": r[1], "metaHash": r[2], "fixedHash": r[3], "version": r[4]}) for r in rows)
+
+def saveBuildState(path, states):
+  conn = openBuildState(path)
+  with conn:
+    conn.executemany("INSERT OR REPLACE INTO boundaryState VALUES (?, ?, ?, ?, ?)",
+                     [(s["boundary"], s["sourceHash"], s["metaHash"], s["fixedHash"], s["version"]) for s in states])
+  conn.close()
+
+def pruneBuildState(path, home, boundaries):
+  #Boundaries that dropped out of the metadata lose their state row and
+  #their fixed output under gbRawData/current.
+  conn = openBuildState(path)
+  with conn:
+    retired = [r[0] for r in conn.execute("SELECT boundary FROM boundaryState").fetchall() if r[0] not in boundaries]
+    conn.executemany("DELETE FROM boundaryState WHERE boundary = ?", [(b,) for b in retired])
+  conn.close()
+  currentDir = home + "/gbRelease/gbRawData/current/"
+  for boundaryDir in glob.glob(currentDir + "*/*/"):
+    iso, adm = boundaryDir[len(currentDir):].strip("/").split("/")
+    if(not (iso + "_" + adm) in boundaries):
+      retired.append(iso + "_" + adm)
+      shutil.rmtree(boundaryDir, ignore_errors=True)
+      if(len(os.listdir(currentDir + iso)) == 0):
+        os.rmdir(currentDir + iso)
+  return sorted(set(retired))
+
+def metaRowHash(gbMeta):
+  return hashlib.md5(gbMeta.to_json().encode("utf-8")).hexdigest()
+
+def fixedShapePath(home, iso, adm):
+  return (home + "/gbRelease/gbRawData/current/" + iso + "/" + adm +
+          "/shapeFixes/" + iso + "_" + adm + "_fixedInternalTopology")
+
+def fixedShapeHash(home, iso, adm):
+  base = fixedShapePath(home, iso, adm)
+  h = hashlib.md5()
+  for ext in [".shp", ".shx", ".dbf"]:
+    if(not os.path.isfile(base + ext)):
+      return None
+    with open(base + ext, 'rb') as f:
+      for chunk in iter(lambda: f.read(1048576), b""):
+        h.update(chunk)
+  return h.hexdigest()
+
+async def downloadAndBuild(nightlyVersion, currentCSV, home, previousCSV, metaChecks,
+                           remoteFileDiff, remoteZips, zipDir, rows, durations):
+  #Each boundary is submitted to the worker pool as soon as its zip is
+  #ready, so downloads overlap with shape checks of earlier boundaries.
+  #rows should already be in the order work is wanted (largest first).
+  executor = get_reusable_executor(max_workers=max(1, cpu_count() - 1))
+  semaphore = asyncio.Semaphore(downloadConcurrency)
+  done = [0]
+
+  async def boundaryTask(i):
+    zipName = str(currentCSV.iloc[i]["Processed File Name"])[:8] + ".zip"
+    #Any error is confined to this boundary, so the state of every
+    #boundary that did build is still saved.
+    try:
+      downloadFailed = False
+      if(remoteFileDiff[i] and (not metaChecks.iloc[i]["metaFail"])):
+        expectedMD5 = None
+        if(remoteZips != None):
+          expectedMD5 = remoteZips.get(zipName[4:8] + "/" + zipName)
+        downloadFailed = not await downloadZip(zipName, zipDir, expectedMD5, semaphore, nightlyVersion)
+
+      future = executor.submit(timedCall, gbBuild, nightlyVersion, currentCSV.iloc[i], home, previousCSV,
+                               metaChecks.iloc[i], remoteFileDiff[i], downloadFailed)
+      result, seconds = await asyncio.wrap_future(future)
+      durations[zipName[:-4]] = seconds
+    except Exception as e:
+      geoLog(nightlyVersion, "CRITICAL", zipName + " failed to download or build: " + repr(e))
+      result = 0
+    done[0] = done[0] + 1
+    print("Built " + zipName + " (" + str(done[0]) + " of " + str(len(rows)) + ")")
+    return result
+
+  return await asyncio.gather(*[boundaryTask(i) for i in rows], return_exceptions=True)
+
+def gbBuild (nightlyVersion, gbMeta, home, previousCSV, metaChecks, remoteFileDiff, downloadFailed=False):
   try:
     boundary = geoBoundary(gbMeta, nightlyVersion, home)
   except ValueError as e:
     geoLog(nightlyVersion, "CRITICAL", "A boundary failed to initialize.  Here is what we know: " + str(e) + "\n" + str(gbMeta))
     return 0
   
-  boundary.metaCheck()
+  boundary.metaCheck(metaChecks)
   if(boundary.metaFail):
     return 0
   
-  boundary.checkForUpdatesDownload(previousCSV)
+  boundary.checkForUpdatesDownload(previousCSV, remoteFileDiff, downloadFailed)
   if(boundary.retrieveFail):
     return 0
   
   boundary.shapeCheckBuild()
+  if(boundary.shapeFail):
+    return 0
+
+  #Hashes for the build state store; written by the parent.
+  return {"boundary": boundary.iso + "_" + boundary.adm,
+          "sourceHash": md5File(boundary.zipPath),
+          "metaHash": metaRowHash(gbMeta),
+          "fixedHash": fixedShapeHash(home, boundary.iso, boundary.adm),
+          "version": nightlyVersion}
   
   
   
   
-#Remove the last iteration to ensure a full file check
-if(os.path.isdir(home + "/gbRelease/gbRawData/current/")):
-  shutil.rmtree(home + "/gbRelease/gbRawData/current/")
-  os.mkdir(home + "/gbRelease/gbRawData/current/")
+#Nightly builds are incremental: gbRawData/current is kept between runs and
+#only boundaries whose zip, metadata row or fixed shapefile changed are
+#rebuilt.  Set fullRebuild=True to remove the last iteration and force a
+#full file check.
+fullRebuild = (os.environ.get('fullRebuild') == "True")
+stateDB = home + "/gbRelease/gbRawData/buildState.sqlite"
+if(fullRebuild):
+  if(os.path.isdir(home + "/gbRelease/gbRawData/current/")):
+    shutil.rmtree(home + "/gbRelease/gbRawData/current/")
+  if(os.path.isfile(stateDB)):
+    os.remove(stateDB)
+if(not os.path.isdir(home + "/gbRelease/gbRawData/current/")):
+  os.makedirs(home + "/gbRelease/gbRawData/current/")
 
 
 #Grab the most recent geoBoundaries metadata
@@ -456,12 +689,71 @@ caseCounts = caseCounts[caseCounts[0] != 2]
 if(len(caseCounts) > 0):
   geoLog(nightlyVersion, "WARN", "NEW OR REMOVED: \n" + caseCounts.to_string())
 
-#Begin high precision single country build for each country.
-with parallel_backend("loky", inner_max_num_threads=1):
-  (Parallel(n_jobs=-2, verbose=100)
-   (delayed(gbBuild)
-    (nightlyVersion, currentCSV.iloc[i], home, previousCSV) 
-    for i in range(len(currentCSV))))
+#Validate all metadata in one pass before dispatching any work.
+validationContext = buildValidationContext(home)
+metaChecks = metaFrameCheck(currentCSV, validationContext)
+if(metaChecks["metaFail"].any()):
+  geoLog(nightlyVersion, "WARN", str(int(metaChecks["metaFail"].sum())) +
+         " boundaries failed metadata checks: \n" +
+         currentCSV[metaChecks["metaFail"]]["Processed File Name"].to_string())
+
+#Diff the remote against our local zips in a single listing.
+zipDir = home + "/gbRelease/gbRawData/currentZips/"
+if(not os.path.isdir(zipDir)):
+  os.makedirs(zipDir)
+remoteZips = remoteManifest(remoteRoot)
+localZips = localZipManifest(zipDir)
+if(remoteZips == None):
+  geoLog(nightlyVersion, "WARN", "The remote listing failed; every boundary will be downloaded.")
+remoteFileDiff = []
+for i in range(len(currentCSV)):
+  zipName = str(currentCSV.iloc[i]["Processed File Name"])[:8] + ".zip"
+  remoteKey = zipName[4:8] + "/" + zipName
+  remoteFileDiff.append((remoteZips == None) or (remoteZips.get(remoteKey) == None) or
+                        (remoteZips.get(remoteKey) != localZips.get(zipName)))
+geoLog(nightlyVersion, "INFO", str(sum(remoteFileDiff)) + " of " + str(len(currentCSV)) +
+       " boundaries differ from the remote.")
+
+retiredBoundaries = pruneBuildState(stateDB, home, set(str(n)[:8] for n in currentCSV["Processed File Name"]))
+if(len(retiredBoundaries) > 0):
+  geoLog(nightlyVersion, "INFO", "Removed " + str(len(retiredBoundaries)) + " retired boundaries: " + ", ".join(retiredBoundaries))
+
+#Only rebuild boundaries whose inputs changed since their last
+#successful build, or whose fixed shapefile has gone missing.
+buildState = loadBuildState(stateDB)
+rebuildRows = []
+for i in range(len(currentCSV)):
+  zipName = str(currentCSV.iloc[i]["Processed File Name"])[:8] + ".zip"
+  state = buildState.get(zipName[:-4])
+  if((state == None) or remoteFileDiff[i] or
+     (state["sourceHash"] != localZips.get(zipName)) or
+     (state["metaHash"] != metaRowHash(currentCSV.iloc[i])) or
+     (state["fixedHash"] == None) or
+     (not os.path.isfile(fixedShapePath(home, zipName[:3], zipName[4:8]) + ".shp"))):
+    rebuildRows.append(i)
+geoLog(nightlyVersion, "INFO", str(len(rebuildRows)) + " of " + str(len(currentCSV)) +
+       " boundaries need rebuilding.")
+
+#Longest job first: order by previous build time scaled by zip size, so
+#the biggest boundaries are not left running alone at the end.
+costs = jobCosts(home + "/gbRelease/gbRawData/jobCosts.json")
+rowSizes = {}
+for i in rebuildRows:
+  zipName = str(currentCSV.iloc[i]["Processed File Name"])[:8] + ".zip"
+  rowSizes[i] = os.path.getsize(zipDir + zipName) if os.path.isfile(zipDir + zipName) else 0
+rebuildRows.sort(key=lambda i: -costs.estimate(str(currentCSV.iloc[i]["Processed File Name"])[:8], rowSizes[i]))
+
+#Begin high precision single country build for each changed country.
+buildDurations = {}
+buildResults = asyncio.run(downloadAndBuild(nightlyVersion, currentCSV, home, previousCSV, metaChecks,
+                                            remoteFileDiff, remoteZips, zipDir, rebuildRows, buildDurations))
+saveBuildState(stateDB, [r for r in buildResults if isinstance(r, dict)])
+for i in rebuildRows:
+  name = str(currentCSV.iloc[i]["Processed File Name"])[:8]
+  if(name in buildDurations):
+    zipName = name + ".zip"
+    costs.record(name, buildDurations[name], os.path.getsize(zipDir + zipName) if os.path.isfile(zipDir + zipName) else 0)
+costs.save()
 
 ############################################################
 ############################################################
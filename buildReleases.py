@@ -5,22 +5,30 @@ import glob
 import os
 import fiona
 import fiona.crs
+import shapely
 import shapely.geometry as geom
+import numpy as np
 from shapely.geometry import shape, mapping, MultiPolygon
-from joblib import Parallel, delayed, parallel_backend
+from joblib import Parallel, delayed, parallel_backend, cpu_count
+from joblib.externals.loky import get_reusable_executor
 import shutil
 import subprocess
 import zipfile
 import json
 import sys
+import re
+from collections import Counter, OrderedDict
 import topojson
 from matplotlib import pyplot as plt
-from shapely.geometry import asShape
-from itertools import chain
+from matplotlib.collections import PolyCollection
 import pickle
 import geojson
+import hashlib
 from osgeo import ogr
 from geojson import Feature, Point, FeatureCollection, Polygon
+from buildUtils import iterFeatures, taskGraph, jobCosts, memoryBudget, sharedMapshaperSession, measuredCall
+from buildUtils import versionPattern, relabelFile
+import buildUtils
 home = expanduser("~")
 
 #Specify Version this release will be:
@@ -38,6 +46,10 @@ else:
 #SSCU - Simplified Single Country Unstandardized 
 builds = ["HPSCU", "SSCU", "GSB", "CGAZ"]
 
+#World view used to attribute LSIB territory for the standardized
+#products; rules are read from worldviews/<name>.csv.
+worldview = os.environ.get("gbWorldview", "USDoS")
+
 
 if (not os.path.isdir(home + '/gbRelease/tmp/')):
             os.mkdir(home + '/gbRelease/tmp/')
@@ -110,95 +122,392 @@ citUse.write("as a non-profit academic project, your citations are what keeps ge
 citUse.write("-Dan Runfola (dan@danrunfola.com)")
 citUse.close()
 
-#Helper functions for conversion from topojson to geojson
-#Hacked together from https://github.com/perrygeo/topo2geojson
-def topoCoordinates(arcs, topology_arcs, scale=None, translate=None):
-    """Return GeoJSON coordinates for the sequence(s) of arcs.
-    
-    The arcs parameter may be a sequence of ints, each the index of a
-    coordinate sequence within topology_arcs
-    within the entire topology -- describing a line string, a sequence of 
-    such sequences -- describing a polygon, or a sequence of polygon arcs.
-    
-    The topology_arcs parameter is a list of the shared, absolute or
-    delta-encoded arcs in the dataset.
-
-    The scale and translate parameters are used to convert from delta-encoded
-    to absolute coordinates. They are 2-tuples and are usually provided by
-    a TopoJSON dataset. 
-    """
-    if isinstance(arcs[0], int):
-        coords = [
-            list(
-                rel2abs(
-                    topology_arcs[arc if arc >= 0 else ~arc],
-                    scale, 
-                    translate )
-                 )[::arc >= 0 or -1][i > 0:] \
-            for i, arc in enumerate(arcs) ]
-        return list(chain.from_iterable(coords))
-    elif isinstance(arcs[0], (list, tuple)):
-        return list(
-            topoCoordinates(arc, topology_arcs, scale, translate) for arc in arcs)
-    else:
-        raise ValueError("Invalid input %s", arcs)
-        
-def rel2abs(arc, scale=None, translate=None):
-    """Yields absolute coordinate tuples from a delta-encoded arc.
-
-    If either the scale or translate parameter evaluate to False, yield the
-    arc coordinates with no transformation."""
-    if scale and translate:
-        a, b = 0, 0
-        for ax, bx in arc:
-            a += ax
-            b += bx
-            yield scale[0]*a + translate[0], scale[1]*b + translate[1]
+#Release-wide log, for steps that do not belong to a single boundary
+#(e.g. CGAZ); same files as releaseCandidateBoundary.geoLog.
+def geoLog(version, errorType, errorMessage):
+  folderPath = home + "/gbRelease/buildLogs/" + version + "/"
+  if not os.path.exists(folderPath):
+    os.makedirs(folderPath, exist_ok=True)
+  filePath = folderPath + errorType + ".txt"
+  while True:
+    try:
+      with open(filePath, 'a') as f:
+        f.write(errorMessage + "\n")
+    except:
+      break
     else:
-        for x, y in arc:
-            yield x, y
-            
-def topoGeometry(obj, topology_arcs, scale=None, translate=None):
-    """Converts a topology object to a geometry object.
-    
-    The topology object is a dict with 'type' and 'arcs' items, such as
-    {'type': "LineString", 'arcs': [0, 1, 2]}.
-
-    See the coordinates() function for a description of the other three
-    parameters.
-    """
-    return {
-        "type": obj['type'], 
-        "coordinates": topoCoordinates(
-            obj['arcs'], topology_arcs, scale, translate )}
-  
-def topo2geojson(topojson_path, geojson_path):
-  with open(topojson_path, 'r') as fh:
-    f = fh.read()
-    topology = json.loads(f)
-
-  # file can be renamed, the first 'object' is more reliable
-  layername = 'data' 
-
+      return 0
+
+#Helper functions for conversion from topojson to geojson.
+#Each arc is decoded once, with a cumulative sum over its delta-encoded
+#positions, and cached; rings are assembled by slicing and concatenating
+#the decoded arrays rather than walking coordinate tuples in Python.
+class topoArcs:
+  "Lazily decoded, cached arc coordinates for one topology."
+  def __init__(self, topology):
+    self.arcs = topology['arcs']
+    self.decoded = [None] * len(self.arcs)
+    self.scale = None
+    self.translate = None
+    if('transform' in topology):
+      self.scale = np.asarray(topology['transform']['scale'], dtype=float)
+      self.translate = np.asarray(topology['transform']['translate'], dtype=float)
+
+  def arc(self, index):
+    #Negative indexes refer to the reversed arc (~index).
+    i = index if index >= 0 else ~index
+    if(self.decoded[i] is None):
+      coords = np.asarray(self.arcs[i], dtype=float)[:, :2]
+      if(self.scale is not None):
+        coords = np.cumsum(coords, axis=0) * self.scale + self.translate
+      self.decoded[i] = coords
+    if(index >= 0):
+      return self.decoded[i]
+    return self.decoded[i][::-1]
+
+  def line(self, arcIndexes):
+    #Consecutive arcs share an endpoint, so drop it from all but the first.
+    parts = [self.arc(arcIndexes[0])] + [self.arc(a)[1:] for a in arcIndexes[1:]]
+    return np.concatenate(parts)
+
+  def position(self, position):
+    #Points are quantized but not delta-encoded.
+    coords = np.asarray(position, dtype=float)[:2]
+    if(self.scale is not None):
+      coords = coords * self.scale + self.translate
+    return coords
+
+  def geometry(self, obj):
+    "Converts a topology object to a shapely geometry (None if empty)."
+    #mapshaper writes features that collapse to nothing (e.g. null-area
+    #polygons) with empty arcs; those become empty geometries.
+    gType = obj.get('type')
+    if(gType == "Polygon"):
+      rings = [self.line(r) for r in obj.get('arcs', []) if len(r) > 0]
+      if(len(rings) == 0):
+        return geom.Polygon()
+      return geom.Polygon(rings[0], rings[1:])
+    if(gType == "MultiPolygon"):
+      return geom.MultiPolygon([geom.Polygon(self.line(p[0]), [self.line(r) for r in p[1:] if len(r) > 0])
+                                for p in obj.get('arcs', []) if len(p) > 0 and len(p[0]) > 0])
+    if(gType == "LineString"):
+      if(len(obj.get('arcs', [])) == 0):
+        return geom.LineString()
+      return geom.LineString(self.line(obj['arcs']))
+    if(gType == "MultiLineString"):
+      return geom.MultiLineString([self.line(l) for l in obj.get('arcs', []) if len(l) > 0])
+    if(gType == "Point"):
+      return geom.Point(self.position(obj['coordinates']))
+    if(gType == "MultiPoint"):
+      return geom.MultiPoint([self.position(p) for p in obj['coordinates']])
+    if(gType == "GeometryCollection"):
+      return geom.GeometryCollection([self.geometry(g) for g in obj['geometries']])
+    return None
+
+def topoLayer(topology, layername='data'):
+  #Returns the properties and a shapely geometry array for one layer.
+  #Falls back to the first object if the layer has been renamed.
+  if(not layername in topology['objects']):
+    layername = list(topology['objects'].keys())[0]
   features = topology['objects'][layername]['geometries']
+  arcs = topoArcs(topology)
+  properties = [tf.get('properties', {}) for tf in features]
+  geoms = np.empty(len(features), dtype=object)
+  geoms[:] = [arcs.geometry(tf) for tf in features]
+  return properties, geoms
 
-  with open(geojson_path, 'w') as dest:
-      fc = {'type': "FeatureCollection", 'features': []}
+def topo2geojson(topojson_path, geojson_path):
+  #Returns the number of features written.
+  with open(topojson_path, 'r') as fh:
+    topology = json.load(fh)
 
-      for id, tf in enumerate(features):
-          f = {'id': id, 'type': "Feature"}
-          f['properties'] = tf['properties'].copy()
+  properties, geoms = topoLayer(topology)
 
-          geommap = topoGeometry(tf, topology['arcs'])
-          geom = asShape(geommap).buffer(0)
-          assert geom.is_valid
-          f['geometry'] = geom.__geo_interface__
+  #Only features that fail validation are repaired.
+  present = ~shapely.is_missing(geoms)
+  invalid = present & ~shapely.is_valid(geoms)
+  if(invalid.any()):
+    geoms[invalid] = shapely.buffer(geoms[invalid], 0)
+    assert shapely.is_valid(geoms[invalid]).all()
 
-          fc['features'].append(f) 
+  return writeGeoJSON(geojson_path, properties, geoms)
 
-      dest.write(json.dumps(fc))
-  return fc
+def writeGeoJSON(geojson_path, properties, geoms):
+  present = ~shapely.is_missing(geoms)
+  geomJSON = np.full(len(geoms), "null", dtype=object)
+  geomJSON[present] = shapely.to_geojson(geoms[present])
 
+  with open(geojson_path, 'w') as dest:
+    dest.write('{"type": "FeatureCollection", "features": [')
+    for id in range(len(geoms)):
+      if(id > 0):
+        dest.write(",")
+      dest.write('{"id": ' + str(id) + ', "type": "Feature", "properties": ' +
+                 json.dumps(properties[id]) + ', "geometry": ' + geomJSON[id] + '}')
+    dest.write(']}')
+  return len(geoms)
+
+#Native clip engine.
+#The mask's parts go into an STRtree and the mask itself is prepared.
+#A feature whose bounding box lies inside the mask is kept untouched,
+#as is any other feature the mask fully contains; features that miss the
+#mask are dropped, and only the ones crossing its edge are intersected,
+#against just the mask parts they touch.
+def polygonal(geometry):
+  if(geometry == None or geometry.is_empty):
+    return None
+  if(geometry.geom_type in ["Polygon", "MultiPolygon"]):
+    return geometry
+  polys = []
+  for part in shapely.get_parts(geometry):
+    if(part.geom_type == "Polygon"):
+      polys.append(part)
+    elif(part.geom_type == "MultiPolygon"):
+      polys.extend(shapely.get_parts(part))
+  if(len(polys) == 0):
+    return None
+  return MultiPolygon(polys) if len(polys) > 1 else polys[0]
+
+def clipFeatures(geoms, mask):
+  #Returns the clipped geometries, which of them to keep, and counts of
+  #interior / intersected / dropped features.
+  clipped = geoms.copy()
+  keep = np.zeros(len(geoms), dtype=bool)
+  parts = shapely.get_parts(mask)
+  tree = shapely.STRtree(parts)
+  shapely.prepare(mask)
+
+  present = np.nonzero(~shapely.is_missing(geoms) & ~shapely.is_empty(geoms))[0]
+  bounds = shapely.bounds(geoms[present])
+  boxes = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+  interior = shapely.contains(mask, boxes)
+  keep[present[interior]] = True
+
+  border = present[~interior]
+  pairs = tree.query(geoms[border], predicate="intersects")
+  touched = np.unique(pairs[0])
+  contained = shapely.contains(mask, geoms[border[touched]])
+  keep[border[touched[contained]]] = True
+
+  crossing = set(touched[~contained].tolist())
+  groups = np.split(pairs[1], np.nonzero(np.diff(pairs[0]))[0] + 1) if len(pairs[0]) > 0 else []
+  intersected = 0
+  for j, hits in zip(np.unique(pairs[0]), groups):
+    if(not j in crossing):
+      continue
+    i = border[j]
+    result = polygonal(shapely.intersection(geoms[i], shapely.union_all(parts[hits])))
+    if(result != None):
+      clipped[i] = result
+      keep[i] = True
+      intersected = intersected + 1
+
+  stats = {"interior": int(interior.sum() + contained.sum()),
+           "intersected": intersected,
+           "dropped": int(len(geoms) - keep.sum())}
+  return clipped, keep, stats
+
+#Hierarchy join.
+#Every child gets one representative point (point_on_surface), and all
+#points are queried against an STRtree of the parent polygons at once.
+#Children whose point lands in exactly one parent take it; those landing
+#in several parents, or in none (slivers, coastline mismatch), fall back
+#to the parent they overlap most.  Returns the parent index of every
+#child (-1 for orphans) and the indexes of ambiguous and orphaned children.
+def hierarchyJoin(childGeoms, parentGeoms):
+  parents = np.full(len(childGeoms), -1, dtype=int)
+  if(len(childGeoms) == 0 or len(parentGeoms) == 0):
+    return parents, [], list(range(len(childGeoms)))
+  present = ~shapely.is_missing(childGeoms)
+  tree = shapely.STRtree(parentGeoms)
+  points = np.empty(len(childGeoms), dtype=object)
+  points[present] = shapely.point_on_surface(childGeoms[present])
+  pairs = tree.query(points, predicate="intersects")
+  hits = np.bincount(pairs[0], minlength=len(childGeoms))
+  single = (hits == 1)
+  parents[pairs[0][single[pairs[0]]]] = pairs[1][single[pairs[0]]]
+
+  ambiguous = np.nonzero(hits > 1)[0].tolist()
+  orphans = []
+  for i in np.nonzero(present & ~single)[0]:
+    candidates = tree.query(childGeoms[i], predicate="intersects")
+    if(len(candidates) > 0):
+      overlap = shapely.area(shapely.intersection(childGeoms[i], parentGeoms[candidates]))
+      if(overlap.max() > 0):
+        parents[i] = candidates[np.argmax(overlap)]
+    if(parents[i] < 0):
+      orphans.append(int(i))
+  orphans = orphans + np.nonzero(~present)[0].tolist()
+  return parents, ambiguous, orphans
+
+#Helper functions for the persistent build cache.
+#Each product is stored under a key built from everything that can change
+#its outputs, so an unchanged boundary is restored instead of rebuilt.
+def fileHash(path, chunkSize=1048576):
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunkSize), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+def toolVersions(home):
+  #Every local file that shapes the products is part of the key: the
+  #build script, its helpers, the mapshaper worker and the worldview rules.
+  scriptDir = home + "/gbRelease"
+  versions = {"fiona": fiona.__version__,
+              "shapely": shapely.__version__,
+              "buildReleases": fileHash(os.path.abspath(__file__)),
+              "buildCore": fileHash(scriptDir + "/buildCore.py"),
+              "buildUtils": fileHash(scriptDir + "/buildUtils.py"),
+              "mapshaperWorker": fileHash(scriptDir + "/mapshaperWorker.js")}
+  for rules in sorted(glob.glob(scriptDir + "/worldviews/*.csv")):
+    versions["worldview:" + os.path.basename(rules)] = fileHash(rules)
+  try:
+    with open(home + "/node_modules/mapshaper/package.json", 'r') as f:
+      versions["mapshaper"] = json.load(f)["version"]
+  except:
+    versions["mapshaper"] = "unknown"
+  return versions
+
+buildToolVersions = toolVersions(home)
+
+
+#Memory budget for this host.  Per-task sessions get at most 8gb of heap;
+#the global merges run once the graph has drained, so they may use up to
+#the whole budget.
+buildMemoryBudget = memoryBudget()
+if(buildMemoryBudget == None):
+  workerHeap = "8gb"
+  globalHeap = "40gb"
+else:
+  workerHeap = str(round(min(8.0, buildMemoryBudget / 1024 ** 3), 1)) + "gb"
+  globalHeap = str(round(buildMemoryBudget / 1024 ** 3, 1)) + "gb"
+
+def getMapshaperSession(heap=None):
+  #One session per worker process and heap size (see buildUtils).
+  if(heap == None):
+    heap = workerHeap
+  return sharedMapshaperSession(home, heap)
+
+def mapshaperFailed(results):
+  return (len(results) == 0) or any(r["status"] != 0 for r in results)
+
+def mapshaperErrors(results):
+  return " | ".join(r["command"] + ": " + r["stderr"] for r in results if r["status"] != 0)
+
+
+#Preview rendering.
+#Each panel is drawn as one PolyCollection.  Rings are snapped to the
+#panel's pixel grid first and repeated pixels dropped, so the number of
+#vertices handed to matplotlib is bounded by the output resolution
+#rather than by the precision of the source data.
+def previewRings(geoFile):
+  rings = []
+  for boundary in iterFeatures(geoFile, fields=[]):
+    geometry = boundary.get("geometry")
+    if(geometry == None):
+      continue
+    if(geometry["type"] == "MultiPolygon"):
+      polys = geometry["coordinates"]
+    elif(geometry["type"] == "Polygon"):
+      polys = [geometry["coordinates"]]
+    else:
+      continue
+    #Only exteriors are drawn, as before.
+    for poly in polys:
+      if(len(poly) > 0 and len(poly[0]) > 0):
+        rings.append(np.asarray(poly[0], dtype=float)[:, :2])
+  return rings
+
+def decimateRings(rings, pixels):
+  if(len(rings) == 0):
+    return rings
+  mins = np.min([r.min(axis=0) for r in rings], axis=0)
+  maxs = np.max([r.max(axis=0) for r in rings], axis=0)
+  pixelSize = max(float((maxs - mins).max()) / max(pixels, 1), 1e-12)
+  decimated = []
+  for ring in rings:
+    grid = np.floor((ring - mins) / pixelSize)
+    keep = np.ones(len(ring), dtype=bool)
+    keep[1:] = np.any(grid[1:] != grid[:-1], axis=1)
+    keep[-1] = True
+    if(keep.sum() >= 3):
+      decimated.append(ring[keep])
+  return decimated
+
+def previewPanel(axs, geoFile, pixels):
+  rings = decimateRings(previewRings(geoFile), pixels)
+  if(len(rings) == 0):
+    return
+  axs.add_collection(PolyCollection(rings, alpha=0.5, facecolors='red', edgecolors='black'))
+  axs.autoscale_view()
+
+#Preview panels for one product: (file, title) pairs, where the title is
+#completed with the file's size.  root is a gbReleaseData folder, so the
+#relabel fast path can re-render previews from the relabeled files.
+def previewPanels(root, release, version, iso, adm):
+  def product(r):
+    prefix = "geoBoundaries" + r + "-"
+    if(r == "HPSCU"):
+      prefix = "geoBoundaries-"
+    return root + r + "/" + iso + "/" + adm + "/" + prefix + version + "-" + iso + "-" + adm + ".geojson"
+  heading = "geoBoundaries " + version.replace("_",".") + "\n" + iso + " " + adm + " "
+  if(release == "HPSCU"):
+    return [(product("HPSCU"), heading + 'High Precision Unstandardized ')]
+  inputs = {"SSCU": ("HPSCU", "High Precision Unstd.", "Simplified Unstd."),
+            "HPSCGS": ("HPSCU", "High Precision Unstd.", "High Precision Std."),
+            "SSCGS": ("SSCU", "Simplified Unstd", "Simplified Std")}
+  source, inputTitle, outputTitle = inputs[release]
+  return [(product(source), heading + '\n' + inputTitle + " "),
+          (product(release), heading + '\n' + outputTitle + " ")]
+
+def previewPath(root, release, version, iso, adm):
+  prefix = "geoBoundariesPreview" + release + "-"
+  if(release == "HPSCU"):
+    prefix = "geoBoundariesPreview-"
+  return root + release + "/" + iso + "/" + adm + "/" + prefix + version + "-" + iso + "-" + adm + ".png"
+
+def renderPreview(outPNG, panels):
+  fig = plt.clf()
+  fig = plt.figure(1, figsize=(10,5), dpi=300)
+  panelPixels = fig.get_figwidth() * fig.dpi / len(panels)
+  for k, (geoFile, title) in enumerate(panels):
+    axs = fig.add_subplot(1, len(panels), k + 1)
+    axs.set_title(title + str(round(os.path.getsize(geoFile) / 1000000,3)) + "MB")
+    previewPanel(axs, geoFile, panelPixels)
+  fig.savefig(outPNG, bbox_inches='tight')
+
+def relabelPreview(dstRoot, relPath, version):
+  #relPath is <release>/<ISO>/<ADM>/<preview>.png under dstRoot.
+  release, iso, adm = relPath.split("/")[:3]
+  renderPreview(dstRoot + relPath, previewPanels(dstRoot, release, version, iso, adm))
+
+#World views.
+#A worldview file is an ordered rule table (rule,match,value,note):
+#"rename" rows map any LSIB name containing match to value, first
+#matching row wins; "iso" rows give the ISO code for a name the ISO
+#table does not resolve.  All rename rows are compiled into a single
+#alternation so each name is tested once.
+def loadWorldview(path):
+  rules = pd.read_csv(path, dtype=str, keep_default_na=False)
+  renames = rules[rules["rule"] == "rename"]
+  isos = rules[rules["rule"] == "iso"]
+  alternatives = [".*?(?P<r" + str(k) + ">" + re.escape(m) + ")" for k, m in enumerate(renames["match"])]
+  if(len(alternatives) == 0):
+    alternatives = ["(?!)"]
+  renamePattern = re.compile("^(?:" + "|".join(alternatives) + ")", re.DOTALL)
+  return renamePattern, list(renames["value"]), dict(zip(isos["match"], isos["value"]))
+
+def isoNameLookup(isoCSV):
+  #Upper-cased ISO country names -> Alpha-3, for names that occur once.
+  #Series.replace only swaps whole values, so names keep their spaces
+  #here while the LSIB side has them stripped; multi-word countries only
+  #resolve through the worldview's iso rows and are otherwise reported
+  #as unmatched.
+  matchCountryCSV = isoCSV["Country"].str.upper().replace(" ","")
+  counts = Counter(matchCountryCSV)
+  return dict((name, code) for name, code in zip(matchCountryCSV, isoCSV["Alpha-3code"])
+              if isinstance(name, str) and counts[name] == 1)
 
 ###################################
 ###################################
@@ -215,8 +524,12 @@ class releaseCandidateBoundary:
     self.BuildComplete_HPSCU = False
     self.BuildComplete_SSCU = False
     self.ID = str(gbMeta["boundaryID"])
-  
+    self.sourceHash = None
+    self.criticalCount = 0
+
   def geoLog(self, errorType, errorMessage):
+    if(errorType == "CRITICAL"):
+      self.criticalCount = self.criticalCount + 1
     folderPath = self.home + "/gbRelease/buildLogs/" + self.version + "/"
     if not os.path.exists(folderPath):
       os.makedirs(folderPath)
@@ -230,7 +543,73 @@ class releaseCandidateBoundary:
       
       else:
         return 0
-  
+
+  def cacheKey(self, release, params):
+    #Every product of this boundary descends from the fixed shapefile
+    #HPSCU reads, so its content is the source hash; a change to the
+    #repair logic in buildCore changes it too.
+    if(self.sourceHash == None):
+      fixedShape = (self.home + "/gbRelease/gbRawData/current/" + self.iso + "/" + self.adm +
+                    "/shapeFixes/" + self.iso + "_" + self.adm + "_fixedInternalTopology")
+      h = hashlib.sha256()
+      for ext in [".shp", ".shx", ".dbf", ".prj", ".cpg"]:
+        if(os.path.isfile(fixedShape + ext)):
+          h.update((ext + fileHash(fixedShape + ext)).encode("utf-8"))
+      self.sourceHash = h.hexdigest()
+    #boundaryID ends in the row's position in the release CSV (-G<n>), so
+    #it stays out of the key; cacheRestore rewrites the metadata instead.
+    keyParts = {"release": release,
+                "version": self.version,
+                "source": self.sourceHash,
+                "meta": self.allMeta.drop(labels=["boundaryID"], errors="ignore").to_json(),
+                "params": params,
+                "tools": buildToolVersions}
+    return hashlib.sha256(json.dumps(keyParts, sort_keys=True).encode("utf-8")).hexdigest()
+
+  def cacheRestore(self, release, key):
+    cacheDir = (self.home + "/gbRelease/buildCache/" + release + "/" + self.iso + "/" + self.adm + "/" + key + "/")
+    outDirectory = (self.home + "/gbRelease/gbReleaseData/" + release + "/" + self.iso + "/" + self.adm + "/")
+    if(not os.path.isfile(cacheDir + "COMPLETE")):
+      return False
+
+    if(os.path.isdir(outDirectory)):
+      shutil.rmtree(outDirectory)
+    #Hard links make a restore effectively free; fall back to a copy
+    #if the cache lives on a different device.
+    try:
+      shutil.copytree(cacheDir, outDirectory, copy_function=os.link,
+                      ignore=shutil.ignore_patterns("COMPLETE"))
+    except OSError:
+      if(os.path.isdir(outDirectory)):
+        shutil.rmtree(outDirectory)
+      shutil.copytree(cacheDir, outDirectory,
+                      ignore=shutil.ignore_patterns("COMPLETE"))
+
+    #Metadata is not part of the key, so it and the full zip carrying it
+    #are written fresh.  Restored files may be hard links into the cache,
+    #so they are unlinked rather than overwritten.
+    for pattern in ["*-metaData.json", "*-metaData.txt", "*-all.zip"]:
+      for stale in glob.glob(outDirectory + pattern):
+        os.remove(stale)
+    self.geoMeta(release)
+    self.buildFullZip(release)
+    self.geoLog("INFO", (self.iso + "|" + self.adm + " " + release + " restored from build cache."))
+    return True
+
+  def cacheStore(self, release, key):
+    cacheRoot = (self.home + "/gbRelease/buildCache/" + release + "/" + self.iso + "/" + self.adm + "/")
+    outDirectory = (self.home + "/gbRelease/gbReleaseData/" + release + "/" + self.iso + "/" + self.adm + "/")
+    tmpDir = cacheRoot + key + ".tmp/"
+    try:
+      #Only the most recent build of each product is kept.
+      if(os.path.isdir(cacheRoot)):
+        shutil.rmtree(cacheRoot)
+      shutil.copytree(outDirectory, tmpDir)
+      open(tmpDir + "COMPLETE", 'w').close()
+      os.rename(tmpDir, cacheRoot + key + "/")
+    except:
+      self.geoLog("WARN", (self.iso + "|" + self.adm + " " + release + " could not be written to the build cache."))
+
   def geoMeta(self, release):
     prefix = "geoBoundaries" + release + "-"
     if(release == "HPSCU"):
@@ -245,71 +624,10 @@ class releaseCandidateBoundary:
                prefix + self.version + "-" + self.iso + "-" + self.adm + "-metaData.txt")
     metaInfo.to_csv(csvOutpath, index=True, header=False, sep=' ')
     
-  def geoViz(self, inputFile, outputFile, release):
-    outputTitle = "High Precision Unstd"
-    if(release == "SSCU"):
-      inputTitle = "High Precision Unstd."
-      outputTitle = "Simplified Unstd."
-    if(release == "HPSCGS"):
-      inputTitle = "High Precision Unstd."
-      outputTitle = "High Precision Std."
-    if(release == "SSCGS"):
-      inputTitle = "Simplified Unstd"
-      outputTitle = "Simplified Std"
-    
-    prefix = "geoBoundariesPreview" + release + "-"
-    if(release == "HPSCU"):
-      prefix = "geoBoundariesPreview-"
-    
-    with open(inputFile, 'r') as j:
-      inputGeom = json.load(j)
-
-    fig = plt.clf()
-    fig = plt.figure(1, figsize=(10,5), dpi=300)
-    axs = fig.add_subplot(121)
-
-    inputSize = round(sys.getsizeof(str(inputGeom)) / 1000000,3)
-
-    axs.set_title("geoBoundaries " + self.version.replace("_",".") + 
-                  "\n" + self.iso + " " + self.adm + " " + 
-                  '\n' + inputTitle + " " + str(inputSize) + "MB")
-
-    #Accounting for Multipolygon Boundaries
-    for boundary in inputGeom["features"]:
-      if(boundary["geometry"]['type'] == "MultiPolygon"):
-        polys = list(shape(boundary["geometry"]))
-        for poly in polys:
-          xs, ys = poly.exterior.xy    
-          axs.fill(xs, ys, alpha=0.5, fc='red', ec='black')
-      else:
-        xs, ys = shape(boundary["geometry"]).exterior.xy    
-        axs.fill(xs, ys, alpha=0.5, fc='red', ec='black')
-
-    axsb = fig.add_subplot(122)
-    
-    with open(outputFile, 'r') as i:
-      outputGeom = json.load(i)
-      
-    outputSize = round(sys.getsizeof(str(outputGeom)) / 1000000,3)
-
-    axsb.set_title("geoBoundaries " + self.version.replace("_",".") + 
-                  "\n" + self.iso + " " + self.adm + " " + 
-                  '\n' + outputTitle + " " + str(outputSize) + "MB")
-
-    #Accounting for Multipolygon Boundaries
-    for boundary in outputGeom["features"]:
-      if(boundary["geometry"]['type'] == "MultiPolygon"):
-        polys = list(shape(boundary["geometry"]))
-        for poly in polys:
-          xs, ys = poly.exterior.xy    
-          axsb.fill(xs, ys, alpha=0.5, fc='red', ec='black')
-      else:
-        xs, ys = shape(boundary["geometry"]).exterior.xy    
-        axsb.fill(xs, ys, alpha=0.5, fc='red', ec='black')
-
-    outgeoPNG = (self.home + "/gbRelease/gbReleaseData/" + release + "/" + self.iso + "/" + self.adm + "/" +
-             prefix + self.version + "-" + self.iso + "-" + self.adm + ".png")
-    fig.savefig(outgeoPNG, bbox_inches='tight')   
+  def geoViz(self, release):
+    root = self.home + "/gbRelease/gbReleaseData/"
+    renderPreview(previewPath(root, release, self.version, self.iso, self.adm),
+                  previewPanels(root, release, self.version, self.iso, self.adm))
       
   def buildFullZip(self, release):
     prefix = "geoBoundaries" + release + "-"
@@ -338,19 +656,18 @@ class releaseCandidateBoundary:
     topoOUT = (self.home + "/gbRelease/gbReleaseData/HPSCU/" + self.iso + "/" + self.adm + "/" +
                "geoBoundaries-" + self.version + "-" + self.iso + "-" + self.adm + ".topojson") 
     shpOUT = (self.home + "/gbRelease/tmp/hpscuTemp" + self.iso + self.adm + "/")
-    finalZipPath = (self.home + "/gbRelease/gbReleaseData/HPSCU/" + self.iso + "/" + self.adm + "/" + "geoBoundaries-" + self.version + "-" + self.iso + "-" + self.adm + "-all.zip")
-    
-    if(os.path.isfile(finalZipPath)):
-      buildTimeStamp = os.path.getmtime(finalZipPath) 
-      zipDownloadTimeStamp = os.path.getmtime(self.home + "/gbRelease/gbRawData/currentZips/" + self.iso + "_" + self.adm + ".zip")
-      if((buildTimeStamp - zipDownloadTimeStamp) > 0):
-        self.BuildComplete_HPSCU = True
-        return 0
-      else:
-        self.geoLog("INFO", (self.iso + "|" + self.adm + " HPSCU build starting."))
+    cacheKey = self.cacheKey("HPSCU", {})
+    criticalCount = self.criticalCount
+
+    if(self.cacheRestore("HPSCU", cacheKey)):
+      self.BuildComplete_HPSCU = True
+      return 0
+    else:
+      self.geoLog("INFO", (self.iso + "|" + self.adm + " HPSCU build starting."))
+      if(os.path.isdir((self.home + "/gbRelease/gbReleaseData/HPSCU/" + self.iso + "/" + self.adm + "/"))):
         shutil.rmtree((self.home + "/gbRelease/gbReleaseData/HPSCU/" + self.iso + "/" + self.adm + "/"))
-        os.mkdir((self.home + "/gbRelease/gbReleaseData/HPSCU/" + self.iso + "/" + self.adm + "/"))
-    
+      os.mkdir((self.home + "/gbRelease/gbReleaseData/HPSCU/" + self.iso + "/" + self.adm + "/"))
+
     outDirectory = self.home + "/gbRelease/gbReleaseData/HPSCU/" + self.iso + "/" + self.adm + "/"
     inShape = (self.home + "/gbRelease/gbRawData/current/" + self.iso + "/" + self.adm + 
                "/shapeFixes/" + self.iso + "_" + self.adm + "_" +
@@ -362,16 +679,21 @@ class releaseCandidateBoundary:
     
     #For uniformity, we'll store all our geoJSONs as multipolygons,
     #even though it's unnecessary for many.  
-    shpFile.schema["geometry"] = "MultiPolygon"
+    schema = shpFile.schema
+    schema["geometry"] = "MultiPolygon"
+    schema["properties"]["shapeID"] = "str:50"
     fid = 0
     kwargs = {"COORDINATE_PRECISION":7}
     with fiona.open(jsonOUT, 'w', driver="GeoJSON", 
-                schema=shpFile.schema,
+                schema=schema,
                 encoding='utf-8',
                 crs=fiona.crs.from_epsg(4326), **kwargs) as write_geojson:
 
       for feature in shpFile:
         fid = fid + 1
+        #The nightly fixed shapefile carries unversioned IDs; the release
+        #version is stamped here, and the HPSCU shapefile and topojson
+        #below are written from this GeoJSON so they carry it too.
         feature["properties"]["shapeID"] = (self.iso + "-" + self.adm + "-" + self.version + "-B" + str(fid)) 
         if(feature["geometry"]["type"] == "MultiPolygon"):
           write_geojson.write(feature)
@@ -389,13 +711,13 @@ class releaseCandidateBoundary:
     else:
       os.mkdir(shpOUT)
     
-    try:
-      mapShaperWriteShape = (self.home + "/node_modules/mapshaper/bin/mapshaper-xl " + inShape +
-                             " -o format=shapefile " + shpOUT +
-                             " -o format=topojson " + topoOUT) 
-      os.system(mapShaperWriteShape)
-    except:
-      self.geoLog("CRITICAL", (self.iso + "|" + self.adm + " Shapefile write failed."))
+    #Same layer name as the fixed shapefile, which downstream products keep.
+    mapShaperWriteShape = ("-i " + jsonOUT + " name=" + self.iso + "_" + self.adm + "_fixedInternalTopology" +
+                           " -o format=shapefile " + shpOUT +
+                           " -o format=topojson " + topoOUT)
+    results = getMapshaperSession().run([mapShaperWriteShape])
+    if(mapshaperFailed(results)):
+      self.geoLog("CRITICAL", (self.iso + "|" + self.adm + " Shapefile write failed. " + mapshaperErrors(results)))
     
     try:
       #Zip the shapefile and output it to the final folder
@@ -410,33 +732,13 @@ class releaseCandidateBoundary:
     
                     
     #Matplotlib Viz - one off for HPSCU
-    with open(jsonOUT, 'r') as j:
-      geoBoundary = json.load(j)
-    fig = plt.clf()
-    fig = plt.figure(1, figsize=(10,5), dpi=300)
-    axs = fig.add_subplot(111)
-
-    mbpost = round(sys.getsizeof(str(geoBoundary)) / 1000000,3)
-
-    axs.set_title("geoBoundaries " + self.version.replace("_",".") + "\n" + self.iso + " " + self.adm + " " + 'High Precision Unstandardized ' + str(mbpost) + "MB")
-
-    #Accounting for Multipolygon Boundaries
-    for boundary in geoBoundary["features"]:
-      if(boundary["geometry"]['type'] == "MultiPolygon"):
-        polys = list(shape(boundary["geometry"]))
-        for poly in polys:
-          xs, ys = poly.exterior.xy    
-          axs.fill(xs, ys, alpha=0.5, fc='red', ec='black')
-      else:
-        xs, ys = shape(boundary["geometry"]).exterior.xy    
-        axs.fill(xs, ys, alpha=0.5, fc='red', ec='black')
-
-    outgeoPNG = (self.home + "/gbRelease/gbReleaseData/HPSCU/" + self.iso + "/" + self.adm + "/"
-             "geoBoundariesPreview-" + self.version + "-" + self.iso + "-" + self.adm + ".png")
-    fig.savefig(outgeoPNG, bbox_inches='tight')
+    self.geoViz("HPSCU")
     
     self.buildFullZip("HPSCU")
-    
+
+    if(self.criticalCount == criticalCount):
+      self.cacheStore("HPSCU", cacheKey)
+
     self.BuildComplete_HPSCU = True
 #################################
 #################################
@@ -447,20 +749,19 @@ class releaseCandidateBoundary:
   def SSCU(self):
     #Simplified single country release
     self.BuildComplete_SSCU = False
-    finalZipPath = (self.home + "/gbRelease/gbReleaseData/SSCU/" + self.iso + "/" + self.adm + "/" + "geoBoundariesSSCU-" + self.version + "-" + self.iso + "-" + self.adm + "-all.zip")
     toposimp = "25%"
-  
-    if(os.path.isfile(finalZipPath)):
-      buildTimeStamp = os.path.getmtime(finalZipPath) 
-      zipDownloadTimeStamp = os.path.getmtime(self.home + "/gbRelease/gbRawData/currentZips/" + self.iso + "_" + self.adm + ".zip")
-      if(buildTimeStamp - zipDownloadTimeStamp > 0):
-        self.BuildComplete_SSCU = True
-        return 0
-      else:
-        self.geoLog("INFO", (self.iso + "|" + self.adm + " SSCU build starting."))
+    cacheKey = self.cacheKey("SSCU", {"simplify": toposimp})
+    criticalCount = self.criticalCount
+
+    if(self.cacheRestore("SSCU", cacheKey)):
+      self.BuildComplete_SSCU = True
+      return 0
+    else:
+      self.geoLog("INFO", (self.iso + "|" + self.adm + " SSCU build starting."))
+      if(os.path.isdir((self.home + "/gbRelease/gbReleaseData/SSCU/" + self.iso + "/" + self.adm + "/"))):
         shutil.rmtree((self.home + "/gbRelease/gbReleaseData/SSCU/" + self.iso + "/" + self.adm + "/"))
-        os.mkdir((self.home + "/gbRelease/gbReleaseData/SSCU/" + self.iso + "/" + self.adm + "/"))
-    
+      os.mkdir((self.home + "/gbRelease/gbReleaseData/SSCU/" + self.iso + "/" + self.adm + "/"))
+
     sB = self.allMeta.copy()
     sB["simplificationRate"] = toposimp
     outDirectory = self.home + "/gbRelease/gbReleaseData/SSCU/" + self.iso + "/" + self.adm + "/"
@@ -478,15 +779,14 @@ class releaseCandidateBoundary:
     else:
       os.mkdir((self.home + "/gbRelease/tmp/simp_" + self.iso + self.adm + "/"))
       
-    try:
-      mapShaperSimplify = (self.home + "/node_modules/mapshaper/bin/mapshaper-xl " + inShape +
-                             " -simplify keep-shapes percentage=" + toposimp + 
-                             " -o format=geojson " + outJSON + 
-                             " -o format=topojson " + outTOPO +
-                             " -o format=shapefile " + outSHP) 
-      os.system(mapShaperSimplify)
-    except:
-      self.geoLog("CRITICAL", (self.iso + "|" + self.adm + " Simplification Failed."))
+    mapShaperSimplify = ("-i " + inShape +
+                         " -simplify keep-shapes percentage=" + toposimp +
+                         " -o format=geojson " + outJSON +
+                         " -o format=topojson " + outTOPO +
+                         " -o format=shapefile " + outSHP)
+    results = getMapshaperSession().run([mapShaperSimplify])
+    if(mapshaperFailed(results)):
+      self.geoLog("CRITICAL", (self.iso + "|" + self.adm + " Simplification Failed. " + mapshaperErrors(results)))
     
     try:
       shutil.make_archive(
@@ -500,10 +800,13 @@ class releaseCandidateBoundary:
       
     self.geoMeta("SSCU")
     
-    self.geoViz(inShape, outJSON, "SSCU")
+    self.geoViz("SSCU")
     
     self.buildFullZip("SSCU")
 
+    if(self.criticalCount == criticalCount):
+      self.cacheStore("SSCU", cacheKey)
+
     self.BuildComplete_SSCU = True
     
 #################################
@@ -518,17 +821,16 @@ class releaseCandidateBoundary:
     count = 0
     notIncludedGSB = ["NIU", "PSE"]
     if(not self.iso in notIncludedGSB):
+      clipPath = self.home + "/gbRelease/gbRawData/ISO_0_Standards/" + worldview + "/" + self.iso + ".topojson"
+      clipHash = fileHash(clipPath)
     
       for buildType in ["HPSCGS", "SSCGS"]:
-        finalZipPath = (self.home + "/gbRelease/gbReleaseData/" + buildType + "/" + self.iso + "/" + self.adm + "/geoBoundaries" + buildType + "-" + self.version + "-" + self.iso + "-" + self.adm + "-all.zip")
         outDirectory = self.home + "/gbRelease/gbReleaseData/"+ buildType + "/" + self.iso + "/" + self.adm + "/"
         outJSON = outDirectory + "geoBoundaries" + buildType + "-" + self.version + "-" + self.iso + "-" + self.adm + ".geojson"
         outTOPO = outDirectory + "geoBoundaries" + buildType + "-" + self.version + "-" + self.iso + "-" + self.adm + ".topojson"
         outSHPTemp = (self.home + "/gbRelease/tmp/" + buildType + self.iso + self.adm + "/" +
                  "geoboundaries" + buildType + "-" + self.version + "-" + self.iso + "-" + self.adm + ".shp")
         outSHP = outDirectory + "geoBoundaries" + buildType + "-" + self.version + "-" + self.iso + "-" + self.adm + "-shp"
-        clipPath = self.home + "/gbRelease/gbRawData/ISO_0_Standards/USDoS/" + self.iso + ".topojson"
-        cleanClipPath = self.home + "/gbRelease/gbRawData/ISO_0_Standards/USDoS/" + self.iso + self.adm + "_clean.topojson"
         
         
         
@@ -554,57 +856,55 @@ class releaseCandidateBoundary:
         if not os.path.isdir((self.home + "/gbRelease/gbReleaseData/SSCGS/" + self.iso + "/" + self.adm + "/")):
           os.mkdir((self.home + "/gbRelease/gbReleaseData/SSCGS/" + self.iso + "/" + self.adm + "/"))
             
-        if(os.path.isfile(finalZipPath)):
-          buildTimeStamp = os.path.getmtime(finalZipPath) 
-          zipDownloadTimeStamp = os.path.getmtime(self.home + "/gbRelease/gbRawData/currentZips/" + self.iso + "_" + self.adm + ".zip")
-          if(buildTimeStamp - zipDownloadTimeStamp > 0):
-            count = count + 1
-            if(count == 2):
-              self.BuildComplete_GSB = True
-              return 0
-            else:
-              continue
+        cacheKey = self.cacheKey(buildType, {"clip": clipHash})
+        criticalCount = self.criticalCount
+        if(self.cacheRestore(buildType, cacheKey)):
+          count = count + 1
+          if(count == 2):
+            self.BuildComplete_GSB = True
+            return 0
           else:
-            self.geoLog("INFO", (self.iso + "|" + self.adm + " " + buildType + " build started.")) 
-            shutil.rmtree((self.home + "/gbRelease/gbReleaseData/" + buildType + "/" + self.iso + "/" + self.adm + "/"))
-            os.mkdir((self.home + "/gbRelease/gbReleaseData/" + buildType + "/" + self.iso + "/" + self.adm + "/"))
-        
+            continue
+        else:
+          self.geoLog("INFO", (self.iso + "|" + self.adm + " " + buildType + " build started."))
+          shutil.rmtree((self.home + "/gbRelease/gbReleaseData/" + buildType + "/" + self.iso + "/" + self.adm + "/"))
+          os.mkdir((self.home + "/gbRelease/gbReleaseData/" + buildType + "/" + self.iso + "/" + self.adm + "/"))
+
         #Need to simplify ISO0 to same standard as other
         #Simplified products in simplify case.
-        if(buildType == "SSCGS"):
-          mapShaperClip = (self.home + "/node_modules/mapshaper/bin/mapshaper-xl" +
-                                 " -i name=data " + clipPath  + 
-                                 " -dissolve2 " +
-                                 " -o format=topojson " + cleanClipPath)
-          process = subprocess.Popen([mapShaperClip], shell=True, 
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-          process.wait()
-          output, error = process.communicate()
-        
-        else:
-          mapShaperClip = (self.home + "/node_modules/mapshaper/bin/mapshaper-xl" +
-                                 " -i name=data " + clipPath  +  
-                                 " -dissolve2 " +
-                                 " -o format=topojson " + cleanClipPath)
-          process = subprocess.Popen([mapShaperClip], shell=True, 
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-          process.wait()
-          output, error = process.communicate()
-
-                     
-        mapShaperErase = (home + "/node_modules/mapshaper/bin/mapshaper-xl" +
-                               " -i " + inGeom + 
-                               " -clip " + cleanClipPath +
-                               " -o format=geojson " + outJSON + 
-                               " -o format=topojson " + outTOPO +
-                               " -o format=shapefile " + outSHPTemp) 
-        process = subprocess.Popen([mapShaperErase], shell=True, 
-                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        
-        
-        process.wait()
-        output, error = process.communicate()
+        try:
+          mask = clipMask(self.iso, clipPath, clipHash)
+        except Exception as e:
+          self.geoLog("CRITICAL", (self.iso + "|" + self.adm + " " + buildType + " clip mask could not be built. " + str(e)))
+          continue
+
+        #Clip in-process; mapshaper only converts the result.  The clip is
+        #written at full float precision, so it goes to tmp and mapshaper
+        #writes the shipped GeoJSON at the HPSCU coordinate precision.
+        clipJSON = self.home + "/gbRelease/tmp/clip_" + buildType + self.iso + self.adm + ".geojson"
+        try:
+          with open(inGeom, 'r') as fh:
+            topology = json.load(fh)
+          layerName = list(topology['objects'].keys())[0]
+          properties, geoms = topoLayer(topology, layerName)
+          clipped, keep, stats = clipFeatures(geoms, mask)
+          writeGeoJSON(clipJSON, [properties[i] for i in np.nonzero(keep)[0]], clipped[keep])
+          self.geoLog("INFO", (self.iso + "|" + self.adm + " " + buildType + " clip: " +
+                               str(stats["interior"]) + " interior, " + str(stats["intersected"]) +
+                               " intersected, " + str(stats["dropped"]) + " dropped."))
+        except Exception as e:
+          self.geoLog("CRITICAL", (self.iso + "|" + self.adm + " " + buildType + " clip failed. " + str(e)))
+          continue
+
+        mapShaperConvert = ("-i " + clipJSON + " name=" + layerName +
+                            " -o format=geojson precision=0.0000001 " + outJSON +
+                            " -o format=topojson " + outTOPO +
+                            " -o format=shapefile " + outSHPTemp)
+        results = getMapshaperSession().run([mapShaperConvert])
+        if(mapshaperFailed(results)):
+          self.geoLog("CRITICAL", (self.iso + "|" + self.adm + " " + buildType + " clip failed. " + mapshaperErrors(results)))
+        if(os.path.isfile(clipJSON)):
+          os.remove(clipJSON)
 
         try:
           shutil.make_archive(
@@ -617,60 +917,329 @@ class releaseCandidateBoundary:
 
         self.geoMeta(buildType)
 
-        self.geoViz(inGeoJson, outJSON, buildType)
+        self.geoViz(buildType)
 
         self.buildFullZip(buildType)
-        
-def buildRelease(builds, geoBoundariesVersion, metaDataRow, home):
-  #Let's not talk about this.
-  for releaseType in builds:
-    if(releaseType != 'GSB'):
-      while True:
-        try:
-          if (not os.path.isdir((home + '/gbRelease/gbReleaseData/' + releaseType + '/' + 
-                               metaDataRow["boundaryISO"] + "/"))):
-            os.mkdir((home + '/gbRelease/gbReleaseData/' + releaseType + '/' + 
-                               metaDataRow["boundaryISO"] + "/"))
-          if (not os.path.isdir((home + '/gbRelease/gbReleaseData/' + releaseType + '/' + 
-                               metaDataRow["boundaryISO"] + "/" + metaDataRow["boundaryType"] + '/'))):
-              os.mkdir((home + '/gbRelease/gbReleaseData/' + releaseType + '/' + 
-                               metaDataRow["boundaryISO"] + "/" + metaDataRow["boundaryType"] + '/'))
-        except:
-          pass
-        else:
-          break
-        
+
+        if(self.criticalCount == criticalCount):
+          self.cacheStore(buildType, cacheKey)
+
+#Clip masks.
+#Every ADM level and both standardized products of a country clip against
+#the same ISO mask.  The LSIB slice is already dissolved by country (see
+#dissolveLSIB), so the mask is just that layer, unioned and prepared once
+#per ISO and clip source hash.  The memo lives in buildUtils so it
+#survives from one task to the next in a pool worker.
+def clipMask(iso, clipPath, clipHash):
+  if(not (iso, clipHash) in buildUtils.clipMasks):
+    with open(clipPath, 'r') as fh:
+      properties, geoms = topoLayer(json.load(fh))
+    mask = shapely.union_all(geoms[~shapely.is_missing(geoms)])
+    shapely.prepare(mask)
+    buildUtils.clipMasks[(iso, clipHash)] = mask
+  return buildUtils.clipMasks[(iso, clipHash)]
+
+#Build graph nodes.
+#Each product of each boundary is its own node, so a boundary's SSCU can
+#start the moment its HPSCU is written, whatever the rest of the world is
+#doing.  A node returns False when its product was not completed.
+stageProducts = {"HPSCU": ["HPSCU"], "SSCU": ["SSCU"], "GSB": ["HPSCGS", "SSCGS"]}
+
+def buildStage(stage, geoBoundariesVersion, metaDataRow, home):
+  for releaseType in stageProducts[stage]:
+    os.makedirs((home + '/gbRelease/gbReleaseData/' + releaseType + '/' + 
+                 metaDataRow["boundaryISO"] + "/" + metaDataRow["boundaryType"] + '/'), exist_ok=True)
+
   #Initialize the boundary object
   boundary = releaseCandidateBoundary(metaDataRow, geoBoundariesVersion, home)
-
-  if("HPSCU" in builds):
-    try:
-      boundary.HPSCU()
-    except:
-      boundary.geoLog("CRITICAL", (boundary.iso + "|" + boundary.adm + " - HPSCU build failed."))
-  
-  if((boundary.BuildComplete_HPSCU == True) and ("SSCU" in builds)):
-    try:
-      boundary.SSCU()
-    except:
-      boundary.geoLog("CRITICAL", (boundary.iso + "|" + boundary.adm + " - SSCU build failed."))
-  
-  elif((boundary.BuildComplete_HPSCU != True) and ("SSCU" in builds)):
-    boundary.geoLog("CRITICAL", (boundary.iso + "|" + boundary.adm + " Cannot build SSCU product without HPSCU completion."))
-  
-  #NOTE: Both standardized products are built in GSB.
-  #We do both standardized products at once for the sake of effeciency.
-  if((boundary.BuildComplete_HPSCU == True) and ("GSB" in builds)):
+  try:
+    getattr(boundary, stage)()
+  except:
+    boundary.geoLog("CRITICAL", (boundary.iso + "|" + boundary.adm + " - " + stage + " build failed."))
+    return False
+
+  if(stage == "HPSCU"):
+    return boundary.BuildComplete_HPSCU
+  if(stage == "SSCU"):
+    return boundary.BuildComplete_SSCU
+  return True
+
+#LSIB clip layers.
+#The cleaned LSIB is split by ISO in a single pass in the parent (see
+#lsibSlices); each changed slice is then dissolved once into
+#<ISO>.topojson by its own graph node.  A .sha256 sidecar records which
+#slice an output was built from, so unchanged ISOs are left alone.
+lsibDissolve = "-dissolve2 COUNTRY_NA"
+
+def lsibSlices(features, isoStdDir):
+  slices = OrderedDict()
+  for feature in features:
+    slices.setdefault(feature['properties']['COUNTRY_NA'], []).append(feature)
+
+  stale = OrderedDict()
+  sliceDir = isoStdDir + "slices/"
+  os.makedirs(sliceDir, exist_ok=True)
+  for iso in slices:
+    if('(disp)' in iso):
+      continue
+    outTOPO = isoStdDir + iso + ".topojson"
+    sliceHash = hashlib.sha256((lsibDissolve + json.dumps(slices[iso], sort_keys=True)).encode("utf-8")).hexdigest()
     try:
-      boundary.GSB()
+      with open(outTOPO + ".sha256") as f:
+        builtHash = f.read().strip()
     except:
-      boundary.geoLog("CRITICAL", (boundary.iso + "|" + boundary.adm + " - GSB build failed."))
-  
-  elif((boundary.BuildComplete_HPSCU != True) and ("GSB" in builds)):
-    boundary.geoLog("CRITICAL", (boundary.iso + "|" + boundary.adm + " Cannot build GSB product without HPSCU completion."))
-    
-    
+      builtHash = None
+    if((builtHash == sliceHash) and os.path.isfile(outTOPO)):
+      continue
+    slicePath = sliceDir + iso + ".geojson"
+    with open(slicePath, 'w') as f:
+      json.dump({"type": "FeatureCollection", "features": slices[iso]}, f)
+    stale[iso] = (slicePath, outTOPO, sliceHash)
+  return stale
+
+def dissolveLSIB(iso, slicePath, outTOPO, sliceHash):
+  mapShaperISO = ("-i " + slicePath + " name=" + iso + " " + lsibDissolve +
+                  " -o format=topojson " + outTOPO)
+  results = getMapshaperSession().run([mapShaperISO])
+  if(mapshaperFailed(results)):
+    geoLog(geoBoundariesVersion, "CRITICAL", iso + " LSIB clip layer could not be built. " + mapshaperErrors(results))
+    return False
+  with open(outTOPO + ".sha256.tmp", 'w') as f:
+    f.write(sliceHash)
+  os.replace(outTOPO + ".sha256.tmp", outTOPO + ".sha256")
+  os.remove(slicePath)
+  return True
+
+#CGAZ
+def buildCGAZ_ADM(iso):
+  #CGAZ nodes run concurrently, so directory creation must tolerate races.
+  for adm in ["ADM0", "ADM1", "ADM2"]:
+    os.makedirs(home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/" + adm + "/", exist_ok=True)
+
+  inTOPOADM2 = (home + "/gbRelease/gbReleaseData/SSCGS/" + iso +
+            "/ADM2/geoBoundariesSSCGS-" + geoBoundariesVersion +
+            "-" + iso + "-" + "ADM2.topojson")
+  inTOPOADM1 = (home + "/gbRelease/gbReleaseData/SSCGS/" + iso +
+            "/ADM1/geoBoundariesSSCGS-" + geoBoundariesVersion +
+            "-" + iso + "-" + "ADM1.topojson")
+  inTOPOADM0 = (home + "/gbRelease/gbReleaseData/SSCGS/" + iso +
+            "/ADM0/geoBoundariesSSCGS-" + geoBoundariesVersion +
+            "-" + iso + "-" + "ADM0.topojson")
   
+  ADM2OUT = home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM2/" + iso + "_ADM2.topojson"
+  ADM1OUT = home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM1/" + iso + "_ADM1.topojson"
+  ADM0OUT = home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM0/" + iso + "_ADM0.topojson"
+
+  #Each SSCGS level is decoded once and children are assigned to parents
+  #in Python (see hierarchyJoin); mapshaper only writes the outputs.
+  #Layers keep the names they carry in the SSCGS topojson.
+  adm2Layer = "geoBoundaries-" + geoBoundariesVersion + "-" + iso + "-ADM2"
+  adm1Layer = "geoBoundaries-" + geoBoundariesVersion + "-" + iso + "-ADM1"
+  adm0Layer = "geoBoundaries-" + geoBoundariesVersion + "-" + iso + "-ADM0"
+  hasADM2 = os.path.isfile(inTOPOADM2)
+  hasADM1 = os.path.isfile(inTOPOADM1)
+  hasADM0 = os.path.isfile(inTOPOADM0)
+
+  levels = {}
+  for adm, inTOPO, hasLevel in [("ADM2", inTOPOADM2, hasADM2), ("ADM1", inTOPOADM1, hasADM1), ("ADM0", inTOPOADM0, hasADM0)]:
+    if(hasLevel):
+      with open(inTOPO, 'r') as fh:
+        levels[adm] = topoLayer(json.load(fh))
+
+  def attachParents(childAdm, parentAdms):
+    properties, geoms = levels[childAdm]
+    hierarchy = [[str(p.get("shapeID"))] for p in properties]
+    for parentAdm in parentAdms:
+      parentProperties, parentGeoms = levels[parentAdm]
+      parents, ambiguous, orphans = hierarchyJoin(geoms, parentGeoms)
+      for i in range(len(properties)):
+        parentID = parentProperties[parents[i]].get("shapeID") if parents[i] >= 0 else None
+        properties[i][parentAdm + "_shapeID"] = parentID
+        hierarchy[i].append(str(parentID) if parentID != None else "")
+      if(len(ambiguous) > 0):
+        geoLog(geoBoundariesVersion, "INFO", iso + "|" + childAdm + " CGAZ: " + str(len(ambiguous)) + " feature(s) fell in more than one " + parentAdm +
+              " and were assigned by largest overlap: " + ", ".join(str(properties[i].get("shapeID")) for i in ambiguous))
+      if(len(orphans) > 0):
+        geoLog(geoBoundariesVersion, "WARN", iso + "|" + childAdm + " CGAZ: " + str(len(orphans)) + " feature(s) have no " + parentAdm +
+              " parent: " + ", ".join(str(properties[i].get("shapeID")) for i in orphans))
+    for i in range(len(properties)):
+      properties[i]["ADMHIERARCHY"] = "|".join(hierarchy[i])
+
+  outputs = []
+  if(hasADM2 and hasADM1 and hasADM0):
+    attachParents("ADM2", ["ADM1", "ADM0"])
+    outputs.append(("ADM2", adm2Layer, ADM2OUT))
+  elif(hasADM2):
+    geoLog(geoBoundariesVersion, "WARN", iso + "|ADM2 CGAZ: cannot be joined to its hierarchy without both ADM1 and ADM0.")
+
+  if(hasADM1 and hasADM0):
+    attachParents("ADM1", ["ADM0"])
+    outputs.append(("ADM1", adm1Layer, ADM1OUT))
+  elif(hasADM1):
+    geoLog(geoBoundariesVersion, "WARN", iso + "|ADM1 CGAZ: cannot be joined to its hierarchy without ADM0.")
+
+  #Copy the ADM0s over
+  if(hasADM0):
+    outputs.append(("ADM0", adm0Layer, ADM0OUT))
+
+  if(len(outputs) > 0):
+    tmpDir = home + "/gbRelease/tmp/cgaz" + iso + "/"
+    os.makedirs(tmpDir, exist_ok=True)
+    mapShaperHierarchy = []
+    for adm, layer, out in outputs:
+      properties, geoms = levels[adm]
+      writeGeoJSON(tmpDir + adm + ".geojson", properties, geoms)
+      mapShaperHierarchy.append("-i " + tmpDir + adm + ".geojson name=" + layer +
+                                " -o format=topojson " + out)
+    results = getMapshaperSession().run(mapShaperHierarchy)
+    shutil.rmtree(tmpDir)
+    if(mapshaperFailed(results)):
+      geoLog(geoBoundariesVersion, "CRITICAL", iso + " CGAZ hierarchy output failed. " + mapshaperErrors(results))
+      return False
+
+
+#Tiled CGAZ gap-fill.
+#Rather than cleaning every country in one process, countries are cut into
+#tiles that are cleaned in parallel.  Each tile owns a set of countries and
+#also loads every country whose ADM0 parts come within cgazTileMargin
+#degrees of them, so any gap touching an owned country is cleaned with the
+#same neighbours it has in the global dataset.  Only owned features are
+#kept; the tiles are then stitched into one topology by the final merge.
+cgazTileMargin = float(os.environ.get("gbCGAZTileMargin", "1.0"))
+
+def cgazPath(iso, adm):
+  return home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/" + adm + "/" + iso + "_" + adm + ".topojson"
+
+def cgazFootprint(iso):
+  #Bounds of each polygon part of the country's coarsest level, and the
+  #x of its largest part.  Parts are used rather than one bounding box so
+  #countries split at the antimeridian do not span the whole globe.
+  for adm in ["ADM0", "ADM1", "ADM2"]:
+    if(os.path.isfile(cgazPath(iso, adm))):
+      with open(cgazPath(iso, adm), 'r') as fh:
+        properties, geoms = topoLayer(json.load(fh))
+      parts = shapely.get_parts(geoms[~shapely.is_missing(geoms)])
+      parts = parts[~shapely.is_empty(parts)]
+      if(len(parts) > 0):
+        bounds = shapely.bounds(parts)
+        largest = np.argmax(shapely.area(parts))
+        return bounds, (bounds[largest][0] + bounds[largest][2]) / 2
+  return None, None
+
+def cgazTiles(isos, nTiles, margin):
+  #Returns a list of (owned, members) ISO lists.  Countries are ordered
+  #west to east and cut into contiguous bands of roughly equal input size.
+  footprints = {}
+  sizes = {}
+  for iso in isos:
+    bounds, x = cgazFootprint(iso)
+    if(bounds is not None):
+      footprints[iso] = (bounds, x)
+      sizes[iso] = sum(os.path.getsize(cgazPath(iso, adm)) for adm in ["ADM0", "ADM1", "ADM2"]
+                       if os.path.isfile(cgazPath(iso, adm)))
+  order = sorted(footprints, key=lambda iso: (footprints[iso][1], iso))
+  if(len(order) == 0):
+    return []
+
+  target = sum(sizes.values()) / max(1, nTiles)
+  bands = [[]]
+  filled = 0
+  for iso in order:
+    bands[-1].append(iso)
+    filled = filled + sizes[iso]
+    if((filled >= target * len(bands)) and (len(bands) < nTiles)):
+      bands.append([])
+  bands = [b for b in bands if len(b) > 0]
+
+  partISO = np.concatenate([np.full(len(footprints[iso][0]), i) for i, iso in enumerate(order)])
+  partBounds = np.concatenate([footprints[iso][0] for iso in order])
+  tree = shapely.STRtree(shapely.box(partBounds[:, 0], partBounds[:, 1], partBounds[:, 2], partBounds[:, 3]))
+  tiles = []
+  for owned in bands:
+    ownedBounds = np.concatenate([footprints[iso][0] for iso in owned])
+    near = tree.query(shapely.box(ownedBounds[:, 0] - margin, ownedBounds[:, 1] - margin,
+                                  ownedBounds[:, 2] + margin, ownedBounds[:, 3] + margin))
+    neighbours = set(order[i] for i in partISO[near[1]])
+    tiles.append((owned, [iso for iso in order if iso in neighbours]))
+  return tiles
+
+def cleanCGAZTile(tileName, owned, members, outPath):
+  levels = []
+  files = []
+  for adm in ["ADM1", "ADM0", "ADM2"]:
+    levelFiles = [cgazPath(iso, adm) for iso in members if os.path.isfile(cgazPath(iso, adm))]
+    if(len(levelFiles) > 0):
+      levels.append(adm)
+      files = files + levelFiles
+  if(len(levels) == 0):
+    return False
+  tileLayers = ",".join(tileName + "-" + adm for adm in levels)
+
+  #Per-ISO layers are named geoBoundaries-<version>-<ISO>-<ADM>; owned
+  #countries are flagged before the levels are merged.
+  mapShaperTile = "-i " + " ".join(files) + " combine-files"
+  for iso in owned:
+    mapShaperTile = mapShaperTile + " -each target=*-" + iso + "-ADM* 'cgazOwned=true'"
+  for adm in levels:
+    mapShaperTile = mapShaperTile + " -merge-layers target=*-" + adm + " force name=" + tileName + "-" + adm
+  mapShaperTile = (mapShaperTile +
+                   " -clean target=" + tileLayers + " gap-fill-area=10000km2 keep-shapes" +
+                   " -filter target=" + tileLayers + " 'cgazOwned === true'" +
+                   " -each target=" + tileLayers + " 'delete cgazOwned'" +
+                   " -o target=" + tileLayers + " format=topojson no-quantization " + outPath)
+  results = getMapshaperSession().run([mapShaperTile])
+  if(mapshaperFailed(results)):
+    print(tileName + " (" + ", ".join(owned) + "): " + mapshaperErrors(results))
+    return False
+  return True
+
+
+#Version relabel fast path.
+#Set relabelFrom to the version the current gbReleaseData was built as
+#(e.g. "manual") to promote it to geoBoundariesVersion without re-running
+#the geometry pipeline.
+if(os.environ.get("relabelFrom", "") != ""):
+  relabelFrom = os.environ["relabelFrom"]
+  if(os.path.isfile(os.path.join((home + "/gbRelease/buildLogs/" + relabelFrom + "/"), "CRITICAL.txt"))):
+    print("You cannot relabel this build, as it still has critical errors.")
+    sys.exit()
+
+  srcRoot = home + "/gbRelease/gbReleaseData/"
+  dstRoot = home + "/gbRelease/gbReleaseData.relabel/"
+  if(os.path.isdir(dstRoot)):
+    shutil.rmtree(dstRoot)
+  pathPattern = versionPattern(relabelFrom, text=True)
+  relabelJobs = []
+  for root, dirs, files in os.walk(srcRoot):
+    for f in files:
+      relPath = os.path.relpath(os.path.join(root, f), srcRoot)
+      relabelJobs.append((os.path.join(root, f), dstRoot + pathPattern.sub(geoBoundariesVersion, relPath)))
+
+  #Preview titles and sizes carry the version, so previews are re-rendered
+  #from the relabeled GeoJSON once it exists, and zips (which embed the
+  #previews) are relabeled last, taking the new previews in.
+  previewJobs = [dst for src, dst in relabelJobs if dst.endswith(".png") and "/geoBoundariesPreview" in dst]
+  fileJobs = [(src, dst) for src, dst in relabelJobs if not (dst in previewJobs or dst.endswith(".zip"))]
+  zipJobs = [(src, dst) for src, dst in relabelJobs if dst.endswith(".zip")]
+  with parallel_backend("loky", inner_max_num_threads=1):
+    (Parallel(n_jobs=-2, verbose=10)
+     (delayed(relabelFile)
+      (src, dst, relabelFrom, geoBoundariesVersion, citeUsePath)
+      for src, dst in fileJobs))
+    (Parallel(n_jobs=-2, verbose=10)
+     (delayed(relabelPreview)
+      (dstRoot, os.path.relpath(dst, dstRoot), geoBoundariesVersion)
+      for dst in previewJobs))
+    (Parallel(n_jobs=-2, verbose=10)
+     (delayed(relabelFile)
+      (src, dst, relabelFrom, geoBoundariesVersion, citeUsePath)
+      for src, dst in zipJobs))
+
+  shutil.rmtree(srcRoot)
+  os.rename(dstRoot, srcRoot)
+  shutil.rmtree(home + "/gbRelease/tmp/")
+  sys.exit()
+
 allMeta = glob.glob((home + "/gbRelease/gbRawData/metadata/*"))
 latestMeta = max(allMeta, key=os.path.getctime)
 nightlyVersion = str(latestMeta).split("/")[-1].split(".")[0]
@@ -727,9 +1296,8 @@ if(not os.path.isfile(os.path.join((home + "/gbRelease/buildLogs/" +
   #http://geonode.state.gov/geoserver/wfs?srsName=EPSG%3A4326&typename=geonode%3AGlobal_LSIB_Polygons_Detailed&outputFormat=json&version=1.0.0&service=WFS&request=GetFeature
   #Filename local: usDoSLSIB_Mar2020.geojson
   if("CGAZ" in builds):
-    isoStdDir = home + "/gbRelease/gbRawData/ISO_0_Standards/USDoS/"
+    isoStdDir = home + "/gbRelease/gbRawData/ISO_0_Standards/" + worldview + "/"
     isoStdData = home + "/gbRelease/gbRawData/ISO_0_Standards/usDoSLSIB_Mar2020.geojson"
-    isoJSONOUT = isoStdDir + "USDoS_ISOstd.geojson"
     if(not os.path.isdir(isoStdDir)):
       os.mkdir(isoStdDir)
 
@@ -738,352 +1306,115 @@ if(not os.path.isfile(os.path.join((home + "/gbRelease/buildLogs/" +
     with open(isoStdData) as f:
       globalDta = json.load(f)
 
+    #Country name cleanup & Contested Areas
+    #Goal here is to reconstruct the worldview's political map
+    #as closely as is possible.  The rules (and the reasoning behind
+    #each) live in worldviews/<gbWorldview>.csv.
     isoCSV = pd.read_csv(home + "/gbRelease/gbRawData/ISO_0_Standards/ISO_3166_1_Alpha_3.csv")
-    isoCSV["matchCountryCSV"] = isoCSV["Country"].str.upper().replace(" ","")
+    renamePattern, renameTo, isoOverrides = loadWorldview(home + "/gbRelease/worldviews/" + worldview + ".csv")
+    isoLookup = isoNameLookup(isoCSV)
     allSourceISOs = []
-    #Messy cleanup of the DoS Boundary.
-    #Will eventually move this pipeline elsewhere.
-    for i in range(0, len(globalDta['features'])):
-      #Country name cleanup & Contested Areas
-      #Goal here is to reconstruct US political worldview
-      #as closely as is possible.
-      #In cases where the US has no official stance,
-      #We base attribution on country population (i.e,)
-      #The country that is contesting that has the larger pop
-      #gets the territory.
-      #This is obviously not a perfect system, and discussion is welcomed.
-      #Over time, we hope to add additional "World View" products.
-      disp = 0
-      if("(disp)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        print("DISP")
-        print(globalDta['features'][i]['properties']['COUNTRY_NA'])
-        disp = 1
-      #Abyei - Status unclear; US view appears to be it is a part of Sudan
-      #Pending ratification of UNIFA changes?
-      if("Abyei" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Sudan"
-      
-      #No official US stance found on Aksai Chin; India pop is estimated
-      #to be slightly higher as of this writing.
-      if("Aksai" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "India"
-      if("CH-IN" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "India"
-      if("Demchok" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "India"
-      
-      #No evidence of US taking a stance, going with Croatia.
-      if("Dragonja" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Croatia"
-      
-      #China is bigger than Bhutan, no evidence of a US stance
-      if("Dramana" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "China"
-      
-      #Adding Gaza to Israel to replicate US view
-      if("Gaza" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Israel"  
-      if("West Bank" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Israel"  
-
-        
-      #Brazil larger; no sign of US stance
-      if("Brasilera" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Brazil"
-      
-      #India bigger than Nepal; no sign of US stance
-      if("Kalapani" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "India"
-  
-      #No sign of US stance
-      if("Koualou" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Burkina Faso"
-      
-      #No sign of US stance Japan / South Korea
-      if("Liancourt" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Japan"
-      
-      #No Man's Land - ascribing to Israel, as US put Israel embassy here.
-      #Unclear if this should count as official stance or not, open for discussion.
-      if("No Man's Land" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Israel"
-        print("NOMAN")
-      #Chinese Island Dispute - China is occupying, US has no formal 
-      if("Paracel" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "China"
-      #Chinese Island Dispute - China is occupying, US has no formal 
-      if("Senkakus" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "China"
-      if("Spratly" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "China"
-   
-      #Looks like Saudi Arabia owns this now, but a bit unclear.
-      if("Sanafir & Tiran" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Saudi Arabia"     
-        print("SANAFIR")
-      #Morocco / West Sahara
-      if("Western Sahara" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Morocco"
-
-      
-      #Kashmir
-      if("Siachen-Saltoro" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "India"
-
-      if(disp == 1):
-        
-        print(globalDta['features'][i]['properties']['COUNTRY_NA'])
-        print("DISPEND")
-        
-      if("(UK)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "United Kingdom"
-
-      if("(US)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "United States"
-
-      if("(Aus)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Australia"
-
-      if("Greenland (Den)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Greenland"
-
-      if("(Den)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Denmark"
-
-      if("(Fr)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "France"
-
-      if("(Ch)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "China"
-
-      if("(Nor)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Norway"
-
-      if("(NZ)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "New Zealand"
-
-      if("Netherlands [Caribbean]" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Netherlands"
-
-      if("(Neth)" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Netherlands"
-
-      if("Portugal [" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Portugal"
-
-      if("Spain [" in globalDta['features'][i]['properties']['COUNTRY_NA']):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = "Spain"
-
-      #Match ISO    
-
-      country = globalDta['features'][i]['properties']['COUNTRY_NA'].upper().replace(" ","")
-      easyMatches = isoCSV[isoCSV["matchCountryCSV"] == country]
-      if(len(easyMatches) == 1):
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = easyMatches.reset_index()["Alpha-3code"][0]
-        allSourceISOs.append(globalDta['features'][i]['properties']['COUNTRY_NA'])
-      else:
-        country = globalDta['features'][i]['properties']['COUNTRY_NA']
-        globalDta['features'][i]['properties']['COUNTRY_NA'] = (country + " No ISO Match")
-        #Manual adjustments:
-        if(country == "Antigua & Barbuda"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "ATG"
-        if(country == "Bahamas, The"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "BHS"
-        if(country == "Bosnia & Herzegovina"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "BIH"
-        if(country == "Congo, Dem Rep of the"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "COD"
-        if(country == "Congo, Rep of the"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "COG"
-        if(country == "Cabo Verde"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "CPV"
-        if(country == "Cote d'Ivoire"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "CIV"
-        if(country == "Central African Rep"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "CAF"
-        if(country == "Czechia"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "CZE"
-        if(country == "Gambia, The"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "GMB"
-        if(country == "Iran"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "IRN"
-        if(country == "Korea, North"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "PRK"
-        if(country == "Korea, South"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "KOR"
-        if(country == "Laos"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "LAO"
-        if(country == "Macedonia"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "MKD"
-        if(country == "Marshall Is"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "MHL"
-        if(country == "Micronesia, Fed States of"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "FSM"
-        if(country == "Moldova"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "MDA"
-        if(country == "Sao Tome & Principe"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "STP"
-        if(country == "Solomon Is"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "SLB"
-        if(country == "St Kitts & Nevis"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "KNA"
-        if(country == "St Lucia"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "LCA"
-        if(country == "St Vincent & the Grenadines"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "VCT"
-        if(country == "Syria"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "SYR"
-        if(country == "Tanzania"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "TZA"
-        if(country == "Vatican City"):
-          globalDta['features'][i]['properties']['COUNTRY_NA'] = "VAT"
-        
-        allSourceISOs.append(globalDta['features'][i]['properties']['COUNTRY_NA'])
+    unmatched = Counter()
+    for feature in globalDta['features']:
+      country = feature['properties']['COUNTRY_NA']
+      rule = renamePattern.match(country)
+      if(rule):
+        country = renameTo[int(rule.lastgroup[1:])]
+
+      #Match ISO
+      iso = isoLookup.get(country.upper().replace(" ",""))
+      if(iso == None):
+        iso = isoOverrides.get(country, country + " No ISO Match")
+        if(iso.endswith(" No ISO Match")):
+          unmatched[country] = unmatched[country] + 1
+      feature['properties']['COUNTRY_NA'] = iso
+      allSourceISOs.append(iso)
+
+    if(len(unmatched) > 0):
+      print(str(len(unmatched)) + " LSIB names had no ISO match under the " + worldview + " worldview:")
+      for country in sorted(unmatched):
+        print("  " + country + " (" + str(unmatched[country]) + " features)")
     
     
-    if(not os.path.isfile(isoJSONOUT)):
-      with open(isoJSONOUT, 'w') as f:
-        json.dump(globalDta, f)
+    staleISOs = lsibSlices(globalDta['features'], isoStdDir)
+    print(str(len(staleISOs)) + " ISO clip layers changed under the " + worldview + " worldview.")
     print(allSourceISOs)
     #sys.exit()
 
-    for iso in allSourceISOs:
-      ##NEED TO UPDATE AND PARALLELIZE THIS
-      #CURRENTLY WILL NOT AUTO-UPDATE ADM0 BOUNDARIES
-      #IF CHANGES ARE MADE OR NEW PRODUCTS BUILT
-      if(not ('(disp)' in iso)):
-        outTOPO = isoStdDir + iso + ".topojson"
-        if(not os.path.isfile(outTOPO)):
-
-          mapShaperISO = (home + "/node_modules/mapshaper/bin/mapshaper-xl " + isoJSONOUT +
-                             " -filter '" + '"' + iso + '"' +
-                             ".indexOf(COUNTRY_NA) > -1' -o " + outTOPO)
-          os.system(mapShaperISO)
-       
-  
+  #Build graph: LSIB split -> GSB clip, HPSCU -> SSCU -> GSB (SSCGS) -> CGAZ.
+  #Everything is scheduled together on one pool, and a failure only
+  #removes the nodes downstream of it.
+  #Nodes are costed from previous builds' timings (or source zip size)
+  #so the largest boundaries are started first.
+  os.makedirs(home + "/gbRelease/buildCache/", exist_ok=True)
+  costs = jobCosts(home + "/gbRelease/buildCache/jobCosts.json")
+  graphSizes = {}
+  graph = taskGraph()
+
+  graphRows = {}
+  for i in range(len(metaData)):
+    row = metaData.iloc[i]
+    key = row["boundaryISO"] + "_" + row["boundaryType"]
+    graphRows[key] = row
+    zipPath = home + "/gbRelease/gbRawData/currentZips/" + key + ".zip"
+    size = os.path.getsize(zipPath) if os.path.isfile(zipPath) else 0
+    graphSizes["HPSCU:" + key] = graphSizes["SSCU:" + key] = graphSizes["GSB:" + key] = size
+    graphSizes["CGAZ:" + row["boundaryISO"]] = graphSizes.get("CGAZ:" + row["boundaryISO"], 0) + size
+    if("HPSCU" in builds):
+      graph.add("HPSCU:" + key, buildStage, ("HPSCU", geoBoundariesVersion, row, home),
+                cost=costs.estimate("HPSCU:" + key, size),
+                memory=costs.estimateMemory("HPSCU:" + key, size))
+    if("SSCU" in builds):
+      graph.add("SSCU:" + key, buildStage, ("SSCU", geoBoundariesVersion, row, home),
+                deps=["HPSCU:" + key], cost=costs.estimate("SSCU:" + key, size),
+                memory=costs.estimateMemory("SSCU:" + key, size))
+    #GSB clips the SSCU output when there is one, but only needs HPSCU
+    #and, when this run rebuilds it, the ISO's LSIB clip layer.
+    if("GSB" in builds):
+      graph.add("GSB:" + key, buildStage, ("GSB", geoBoundariesVersion, row, home),
+                deps=["HPSCU:" + key, "LSIB:" + row["boundaryISO"]], after=["SSCU:" + key],
+                cost=costs.estimate("GSB:" + key, size),
+                memory=costs.estimateMemory("GSB:" + key, size))
+
+  if("CGAZ" in builds):
+    for iso in staleISOs:
+      graph.add("LSIB:" + iso, dissolveLSIB, (iso,) + staleISOs[iso],
+                cost=costs.estimate("LSIB:" + iso), memory=costs.estimateMemory("LSIB:" + iso))
+
+  #CGAZ copes with missing levels itself, so it only waits on GSB.
+  if("CGAZ" in builds):
+    for iso in set(allSourceISOs):
+      graph.add("CGAZ:" + iso, buildCGAZ_ADM, (iso,),
+                after=["GSB:" + iso + "_ADM0", "GSB:" + iso + "_ADM1", "GSB:" + iso + "_ADM2"],
+                cost=costs.estimate("CGAZ:" + iso, graphSizes.get("CGAZ:" + iso, 0)),
+                memory=costs.estimateMemory("CGAZ:" + iso, graphSizes.get("CGAZ:" + iso, 0)))
+
   #Launch the ships:
-  with parallel_backend("loky", inner_max_num_threads=1):
-    (Parallel(n_jobs=-2, verbose=100)
-     (delayed(buildRelease)
-      (builds, geoBoundariesVersion, metaData.iloc[i], home) 
-      for i in range(len(metaData))))
+  workers = max(1, cpu_count() - 1)
+  #Tasks are only admitted while their estimated peak memory fits the
+  #host's budget; measured peaks refine the estimates for the next run.
+  graphStatus = graph.run(get_reusable_executor(max_workers=workers), maxRunning=workers,
+                          memoryBudget=buildMemoryBudget)
+  for name in graph.durations:
+    costs.record(name, graph.durations[name], graphSizes.get(name, 0), graph.peaks.get(name))
+  costs.save()
+  for name in graphStatus:
+    stage, key = name.split(":", 1)
+    if((graphStatus[name] == "skipped") and (key in graphRows)):
+      missing = "HPSCU"
+      if((stage == "GSB") and (graphStatus.get("HPSCU:" + key, "done") == "done") and
+         (graphStatus.get("LSIB:" + graphRows[key]["boundaryISO"], "done") != "done")):
+        missing = "LSIB clip layer"
+      releaseCandidateBoundary(graphRows[key], geoBoundariesVersion, home).geoLog("CRITICAL",
+        (key.replace("_", "|") + " Cannot build " + stage + " product without " + missing + " completion."))
 else:
   print("You cannot create this build, as it still has critical errors.")
   sys.exit()
   
-#CGAZ
-def buildCGAZ_ADM(iso):
-  if(not os.path.isdir(home + "/gbRelease/gbReleaseData/CGAZ/")):
-      os.mkdir(home + "/gbRelease/gbReleaseData/CGAZ/")
-      os.mkdir(home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/")
-      os.mkdir(home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM1/")
-      os.mkdir(home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM2/") 
-      
-  inTOPOADM2 = (home + "/gbRelease/gbReleaseData/SSCGS/" + iso +
-            "/ADM2/geoBoundariesSSCGS-" + geoBoundariesVersion +
-            "-" + iso + "-" + "ADM2.topojson")
-  inTOPOADM1 = (home + "/gbRelease/gbReleaseData/SSCGS/" + iso +
-            "/ADM1/geoBoundariesSSCGS-" + geoBoundariesVersion +
-            "-" + iso + "-" + "ADM1.topojson")
-  inTOPOADM0 = (home + "/gbRelease/gbReleaseData/SSCGS/" + iso +
-            "/ADM0/geoBoundariesSSCGS-" + geoBoundariesVersion +
-            "-" + iso + "-" + "ADM0.topojson")
-  
-  outTMPTopoA = (home + "/gbRelease/tmp/CGAZ_" + iso + "adm2Temp.topojson")
-  outTMPTopoB = (home + "/gbRelease/tmp/CGAZ_" + iso + "adm2TempB.topojson")
-  outTMPTopoC = (home + "/gbRelease/tmp/CGAZ_" + iso + "adm2TempC.topojson")
-  ADM2OUT = home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM2/" + iso + "_ADM2.topojson"
-  ADM1OUT = home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM1/" + iso + "_ADM1.topojson"
-  ADM0OUT = home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM0/" + iso + "_ADM0.topojson"
-
-  if(os.path.isfile(inTOPOADM2)):
-    mapShaperJoinADM1 = (home + "/node_modules/mapshaper/bin/mapshaper-xl " + inTOPOADM2 +
-                                 " -join "+ inTOPOADM1 +
-                                 " fields=shapeID" + 
-                                 " prefix=ADM1_" + 
-                                 " point-method" +
-                                 " -o format=topojson " + outTMPTopoA)
-    
-    
-    process = subprocess.Popen([mapShaperJoinADM1], shell=True, 
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
-    output, error = process.communicate()
-    print(str(error) + mapShaperJoinADM1)
-
-    mapShaperJoinADM0 = (home + "/node_modules/mapshaper/bin/mapshaper-xl " + outTMPTopoA +
-                               " -join "+ inTOPOADM0 +
-                               " fields=shapeID" + 
-                               " prefix=ADM0_" + 
-                               " point-method" +
-                               " -o format=topojson " + outTMPTopoB)
-
-    process = subprocess.Popen([mapShaperJoinADM0], shell=True, 
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
-    output, error = process.communicate()
-    print(str(error) + mapShaperJoinADM0)
-
-    mapShaperFullHierarcy = (home + "/node_modules/mapshaper/bin/mapshaper-xl " + outTMPTopoB +
-                               " -each 'ADMHIERARCHY=shapeID.concat(" + '"|"' +").concat(ADM1_shapeID).concat(" + '"|"' +").concat(ADM0_shapeID)'"
-                               " -o format=topojson " + ADM2OUT)
-    
-    process = subprocess.Popen([mapShaperFullHierarcy], shell=True, 
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
-    output, error = process.communicate()
-    print(str(error) + mapShaperFullHierarcy)
-    
-  if(os.path.isfile(inTOPOADM1)):
-    #Repeat for ADM1
-    mapShaperJoinADM1_ADM0 = (home + "/node_modules/mapshaper/bin/mapshaper-xl " + inTOPOADM1 +
-                                 " -join "+ inTOPOADM0 +
-                                 " fields=shapeID" + 
-                                 " prefix=ADM0_" + 
-                                 " point-method" +
-                                 " -o format=topojson " + outTMPTopoA)
-
-    process = subprocess.Popen([mapShaperJoinADM1_ADM0], shell=True, 
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
-    output, error = process.communicate()
-    print(str(error) + str(mapShaperJoinADM1_ADM0))
-    
-    mapShaperFullHierarcy = (home + "/node_modules/mapshaper/bin/mapshaper-xl " + outTMPTopoA +
-                                 " -each 'ADMHIERARCHY=shapeID.concat(" + '"|"' +").concat(ADM0_shapeID)'"
-                                 " -o format=topojson " + ADM1OUT)
-    
-    process = subprocess.Popen([mapShaperFullHierarcy], shell=True, 
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
-    output, error = process.communicate()
-    print(str(error) + str(mapShaperFullHierarcy))
-    
-  #Copy the ADM0s over
-  if(os.path.isfile(inTOPOADM0)):
-    mapShaperCopyADM0 = (home + "/node_modules/mapshaper/bin/mapshaper-xl " + inTOPOADM0 +
-                           " -o format=topojson " + ADM0OUT)
-
-    process = subprocess.Popen([mapShaperCopyADM0], shell=True, 
-                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
-    output, error = process.communicate()
-    print(str(error) + str(mapShaperCopyADM0))
-  
-  
 if("CGAZ" in builds):
-  with parallel_backend("loky", inner_max_num_threads=1):
-    (Parallel(n_jobs=-2, verbose=100)
-     (delayed(buildCGAZ_ADM)
-      (list(set(allSourceISOs))[i]) 
-      for i in range(len(list(set(allSourceISOs))))))
-  
-  adm1str = (home + "/node_modules/mapshaper/bin/mapshaper-xl 40gb " +
-             "-i ")
-  adm2str = (home + "/node_modules/mapshaper/bin/mapshaper-xl 40gb " +
-             "-i ")
-  adm0str = (home + "/node_modules/mapshaper/bin/mapshaper-xl 40gb " +
-             "-i ")
+  adm1str = "-i "
+  adm2str = "-i "
+  adm0str = "-i "
   adm1renameLayers = "id1"
   adm2renameLayers = "id1"
   adm0renameLayers = "id1"
@@ -1097,64 +1428,105 @@ if("CGAZ" in builds):
   if(not os.path.isdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM2/"))):
      os.mkdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM2/"))     
 
+  admFiles = {"ADM0": [], "ADM1": [], "ADM2": []}
   for iso in list(set(allSourceISOs)):
     count = count + 1
-    if(os.path.isfile((home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM1/" + iso + "_ADM1.topojson"))):
-      adm1str = adm1str + (home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM1/" + iso + "_ADM1.topojson ")
-    if(os.path.isfile((home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM2/" + iso + "_ADM2.topojson"))):
-      adm2str = adm2str + (home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM2/" + iso + "_ADM2.topojson ")
-    if(os.path.isfile((home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM0/" + iso + "_ADM0.topojson"))):
-      adm0str = adm0str + (home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/ADM0/" + iso + "_ADM0.topojson ")
-  
-  #Here we go! Loop this for four different simplification levels.
-  simplify = ["100", "75", "50", "25", "10"]
+    for adm in admFiles:
+      if(os.path.isfile((home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/" + adm + "/" + iso + "_" + adm + ".topojson"))):
+        admFiles[adm].append(home + "/gbRelease/gbReleaseData/CGAZ/" + iso + "/" + adm + "/" + iso + "_" + adm + ".topojson")
+  adm0str = adm0str + " ".join(admFiles["ADM0"])
+  adm1str = adm1str + " ".join(admFiles["ADM1"])
+  adm2str = adm2str + " ".join(admFiles["ADM2"])
   
+  #Gap-fill cleaning runs per tile, in parallel (see cleanCGAZTile).
+  #Set gbCGAZTiles to change the number of tiles.
+  tileDir = home + "/gbRelease/tmp/cgazTiles/"
+  os.makedirs(tileDir, exist_ok=True)
+  tiles = cgazTiles(list(set(allSourceISOs)), int(os.environ.get("gbCGAZTiles", str(workers * 2))), cgazTileMargin)
+  print("Cleaning CGAZ in " + str(len(tiles)) + " tiles.")
+  tileGraph = taskGraph()
+  tileSizes = {}
+  for n, (owned, members) in enumerate(tiles):
+    tileName = "cgazTile" + str(n)
+    tileSizes[tileName] = sum(os.path.getsize(cgazPath(iso, adm)) for iso in members for adm in ["ADM0", "ADM1", "ADM2"]
+                              if os.path.isfile(cgazPath(iso, adm)))
+    tileGraph.add(tileName, cleanCGAZTile, (tileName, owned, members, tileDir + tileName + ".topojson"),
+                  cost=costs.estimate(tileName, tileSizes[tileName]),
+                  memory=costs.estimateMemory(tileName, tileSizes[tileName]))
+  tileStatus = tileGraph.run(get_reusable_executor(max_workers=workers), maxRunning=workers,
+                             memoryBudget=buildMemoryBudget)
+  for name in tileGraph.durations:
+    costs.record(name, tileGraph.durations[name], tileSizes.get(name, 0), tileGraph.peaks.get(name))
+  costs.save()
+  tileFiles = [tileDir + name + ".topojson" for name in tileStatus if tileStatus[name] == "done"]
+  if(len(tileFiles) < len(tiles)):
+    print(str(len(tiles) - len(tileFiles)) + " CGAZ tile(s) failed; their countries are missing from CGAZ.")
+
+  #Here we go!  The cleaned tiles are read into one dataset, so all three
+  #levels share a single arc store and each ratio ranks every border once
+  #for all levels.  Only edges that already share coordinates become shared
+  #arcs, though: each level and country comes from its own SSCGS file,
+  #simplified independently upstream, so an ADM0 edge and the ADM1/ADM2
+  #edges under it, or two neighbours owned by different tiles, can still
+  #differ by a few vertices.  There is no global clean to reconcile them
+  #(that is what the tiles avoid); buildTests/cgazCheck.py reports any
+  #overlap left at the seams.
+  #mapshaper keeps the full-resolution vertices after -simplify and re-ranks
+  #them on every call, so the ratios do not compound, but the ranks cannot
+  #be reused between calls either; the 100% ratio removes nothing, so it is
+  #written first and without a -simplify pass.  Set gbCGAZRatios (comma
+  #separated) to change the ratios.
+  simplify = [r.strip() for r in os.environ.get("gbCGAZRatios", "100,75,50,25,10").split(",") if r.strip() != ""]
+  simplify = sorted(simplify, key=float, reverse=True)
+  cgazLevels = [adm for adm in ["ADM1", "ADM0", "ADM2"] if len(admFiles[adm]) > 0]
+  globalLayers = ",".join("global" + adm for adm in cgazLevels)
+
+  #Tile layers are named cgazTile<n>-<ADM>.  Tiles are written without
+  #quantization, so the stitch does not move any vertex; snap only joins
+  #vertices that differ by rounding.
+  mapShaperFull = "-i " + " ".join(tileFiles) + " combine-files snap"
+  for adm in cgazLevels:
+    mapShaperFull = (mapShaperFull +
+                     " -merge-layers target=*-" + adm + " force" +
+                     " name=global" + adm)
+
   for ratio in simplify:
-    if(not os.path.isdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM1/simplifyRatio_" + ratio))):
-      os.mkdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM1/simplifyRatio_" + ratio)) 
-      os.mkdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM1/simplifyRatio_" + ratio + "/shp/"))  
-    if(not os.path.isdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM2/simplifyRatio_" + ratio))):
-      os.mkdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM2/simplifyRatio_" + ratio))  
-      os.mkdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM2/simplifyRatio_" + ratio + "/shp/"))  
-    if(not os.path.isdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM0/simplifyRatio_" + ratio))):
-      os.mkdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM0/simplifyRatio_" + ratio))  
-      os.mkdir((home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM0/simplifyRatio_" + ratio + "/shp/"))  
-  
-    mapShaperFullADM1 = (adm1str + 
-                       " combine-files -merge-layers force" +
-                       " name=globalADM1" +
-                       " -clean gap-fill-area=10000km2 keep-shapes" +
-                       " -simplify weighted " + ratio + "% keep-shapes" +
-                       " -o format=topojson " + (home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM1/simplifyRatio_"+ratio+"/geoBoundariesCGAZ-"+geoBoundariesVersion+"-ADM1.topojson") +
-                       " -o format=geojson " + (home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM1/simplifyRatio_"+ratio+"/geoBoundariesCGAZ-"+geoBoundariesVersion+"-ADM1.geojson") +
-                       " -o format=shapefile " + (home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM1/simplifyRatio_"+ratio+"/shp/geoBoundariesCGAZ-"+geoBoundariesVersion+"-ADM1.shp")       
-                      )
-  
-    os.system(mapShaperFullADM1)
-  
-    mapShaperFullADM0 = (adm0str + 
-                       " combine-files -merge-layers force" +
-                       " name=globalADM0" +
-                       " -clean gap-fill-area=10000km2 keep-shapes" +
-                       " -simplify weighted " + ratio + "% keep-shapes" +
-                       " -o format=topojson " + (home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM0/simplifyRatio_"+ratio+"/geoBoundariesCGAZ-"+geoBoundariesVersion+"-ADM0.topojson") +
-                       " -o format=geojson " + (home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM0/simplifyRatio_"+ratio+"/geoBoundariesCGAZ-"+geoBoundariesVersion+"-ADM0.geojson") +
-                       " -o format=shapefile " + (home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM0/simplifyRatio_"+ratio+"/shp/geoBoundariesCGAZ-"+geoBoundariesVersion+"-ADM0.shp")       
-                      )
-  
-    os.system(mapShaperFullADM0)
-  
-    mapShaperFullADM2 = (adm2str + 
-                       " combine-files -merge-layers force" +
-                       " name=globalADM2" +
-                       " -clean gap-fill-area=10000km2 keep-shapes" +
-                       " -simplify weighted " + ratio + "% keep-shapes" +
-                       " -o format=topojson " + (home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM2/simplifyRatio_"+ratio+"/geoBoundariesCGAZ-"+geoBoundariesVersion+"-ADM2.topojson") +
-                       " -o format=geojson " + (home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM2/simplifyRatio_"+ratio+"/geoBoundariesCGAZ-"+geoBoundariesVersion+"-ADM2.geojson") +
-                       " -o format=shapefile " + (home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ADM2/simplifyRatio_"+ratio+"/shp/geoBoundariesCGAZ-"+geoBoundariesVersion+"-ADM2.shp")       
-                      )
-  
-    os.system(mapShaperFullADM2)
+    if(float(ratio) < 100):
+      mapShaperFull = mapShaperFull + " -simplify target=" + globalLayers + " weighted percentage=" + ratio + "% keep-shapes"
+    for adm in cgazLevels:
+      ratioDir = home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/" + adm + "/simplifyRatio_" + ratio + "/"
+      os.makedirs(ratioDir + "shp/", exist_ok=True)
+      mapShaperFull = (mapShaperFull +
+                       " -o target=global" + adm + " format=topojson " + (ratioDir + "geoBoundariesCGAZ-" + geoBoundariesVersion + "-" + adm + ".topojson") +
+                       " -o target=global" + adm + " format=geojson " + (ratioDir + "geoBoundariesCGAZ-" + geoBoundariesVersion + "-" + adm + ".geojson") +
+                       " -o target=global" + adm + " format=shapefile " + (ratioDir + "shp/geoBoundariesCGAZ-" + geoBoundariesVersion + "-" + adm + ".shp"))
+    #All levels in one topojson, every shared border stored once.
+    ratioDir = home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/ALL/simplifyRatio_" + ratio + "/"
+    os.makedirs(ratioDir, exist_ok=True)
+    mapShaperFull = (mapShaperFull +
+                     " -o target=" + globalLayers + " format=topojson " + (ratioDir + "geoBoundariesCGAZ-" + geoBoundariesVersion + "-ALL.topojson"))
+
+  #The stitch gets the heap its last measured peak scales to for this
+  #run's tiles, with headroom, rather than the whole budget; the first run
+  #has nothing to scale from and uses globalHeap, as does the retry when a
+  #smaller heap runs out.
+  if(len(cgazLevels) > 0 and len(tileFiles) > 0):
+    stitchSize = sum(os.path.getsize(f) for f in tileFiles)
+    stitchHeap = globalHeap
+    if(costs.history.get("cgazStitch", {}).get("peak")):
+      stitchBytes = costs.estimateMemory("cgazStitch", stitchSize) * 1.5
+      stitchHeap = str(round(max(1.0, min(stitchBytes / 1024 ** 3, float(globalHeap[:-2]))), 1)) + "gb"
+    print("Stitching " + str(len(tileFiles)) + " CGAZ tiles with a " + stitchHeap + " heap.")
+    results, seconds, peak = measuredCall(getMapshaperSession(stitchHeap).run, [mapShaperFull])
+    if(mapshaperFailed(results) and stitchHeap != globalHeap):
+      print("CGAZ stitch failed with a " + stitchHeap + " heap; retrying with " + globalHeap + ".")
+      getMapshaperSession(stitchHeap).close()
+      results, seconds, peak = measuredCall(getMapshaperSession(globalHeap).run, [mapShaperFull])
+    if(mapshaperFailed(results)):
+      print(mapshaperErrors(results))
+    else:
+      costs.record("cgazStitch", seconds, stitchSize, peak)
+      costs.save()
   
 shutil.rmtree(home + "/gbRelease/tmp/") 
       
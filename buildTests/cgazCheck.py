@@ -1,27 +1,35 @@
-import geojson
+import os
+import sys
 from os.path import expanduser
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from joblib import Parallel, delayed
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buildUtils import countJSONArray, iterFeatures
 
 home = expanduser("~")
 version = "development"
 
+#Same names buildReleases.py writes the stitched products under.
+def cgazPath(l, r):
+  return home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/"+l+"/simplifyRatio_" + r + "/geoBoundariesCGAZ-"+version+"-"+l+".geojson"
+
+#Features are streamed rather than loaded, so each count runs in constant
+#memory and the checks can run side by side.
 ratio = ["10", "25", "50", "75", "100"]
 level = ["ADM0", "ADM1", "ADM2"]
-counts = []
-for l in level:
-  for r in ratio:
-    path = home + "/gbRelease/gbReleaseData/CGAZ/!CGAZ/"+l+"/simplifyRatio_" + r + "/geoBoundariesCGAZ_" +l+".geojson"
-    with open(path, 'r', encoding="ISO-8859-1") as j:
-      temp = j.read()
-    
-    geoBoundaries = geojson.loads(temp)
-    counts.append([l, r, len(geoBoundaries['features'])])
-    
-    #ADM2 Expectation:
-    #114673 ADM2 True
-    #3332 ADM1 True
-    #200 ADM0 True
-    #ADM0 - we drop two - ["NIU", "PSE"] - not recognized by US for standard
-    
+cases = [(l, r) for l in level for r in ratio]
+paths = [cgazPath(l, r) for l, r in cases]
+counts = Parallel(n_jobs=-2)(delayed(countJSONArray)(p, "features", "ISO-8859-1") for p in paths)
+counts = [[l, r, c] for (l, r), c in zip(cases, counts)]
+
+#ADM2 Expectation:
+#114673 ADM2 True
+#3332 ADM1 True
+#200 ADM0 True
+#ADM0 - we drop two - ["NIU", "PSE"] - not recognized by US for standard
+
 
 #Compare ADM2 Ireland 2 for differences between products as a check
 I = {}
@@ -31,15 +39,46 @@ I['SSCGS'] = home + "/gbRelease/gbReleaseData/SSCGS/IRL/ADM2/geoBoundariesSSCGS-
 I['HPSCU'] = home + "/gbRelease/gbReleaseData/HPSCU/IRL/ADM2/geoBoundaries-"+version+"-IRL-ADM2.geojson"
 I['HPSCGS'] = home + "/gbRelease/gbReleaseData/HPSCGS/IRL/ADM2/geoBoundariesHPSCGS-"+version+"-IRL-ADM2.geojson"
 
+#The CGAZ ISO file is topojson with a single object, so its
+#first geometries array is the one we want.
 productCounts = []
-
 for i in I:
-  with open(I[i], 'r', encoding="ISO-8859-1") as j:
-    temp = j.read()
-  
-  geoBoundaries = geojson.loads(temp)
-  
   if(i == "CGAZ"):
-    productCounts.append([i, len(geoBoundaries['objects']['geoBoundaries-development-IRL-ADM2']['geometries'])])
+    productCounts.append([i, countJSONArray(I[i], "geometries", "ISO-8859-1")])
   else:
-    productCounts.append([i, len(geoBoundaries['features'])])
\ No newline at end of file
+    productCounts.append([i, countJSONArray(I[i], "features", "ISO-8859-1")])
+
+#CGAZ is gap-filled in parallel tiles (see cleanCGAZTile) and stitched
+#back together, so check that no two shapes overlap anywhere, including
+#between countries cleaned in different tiles.  Shapes that touch along a
+#border intersect with zero area; anything with area is an overlap,
+#whether the shapes cross or one sits inside the other.  Only geometries
+#and IDs are kept, and pairs are tested a block at a time.
+def overlaps(path, block=10000):
+  geoms = []
+  labels = []
+  for feature in iterFeatures(path, ["shapeGroup", "shapeID"], encoding="ISO-8859-1"):
+    geoms.append(shape(feature["geometry"]) if feature["geometry"] != None else None)
+    labels.append(str(feature["properties"]["shapeID"]) + " (" + str(feature["properties"]["shapeGroup"]) + ")")
+  geoms = np.array(geoms, dtype=object)
+  tree = shapely.STRtree(geoms)
+  found = []
+  for start in range(0, len(geoms), block):
+    left, right = tree.query(geoms[start:start + block], predicate="intersects")
+    left = left + start
+    pairs = left < right
+    left = left[pairs]
+    right = right[pairs]
+    areas = shapely.area(shapely.intersection(geoms[left], geoms[right]))
+    for a, b, area in zip(left, right, areas):
+      if(area > 0):
+        found.append([labels[a], labels[b], area])
+  return found
+
+overlapCounts = []
+for l in level:
+  found = overlaps(cgazPath(l, "100"))
+  for a, b, area in found:
+    print(l + " overlap: " + a + " / " + b + " " + str(area))
+  overlapCounts.append([l, len(found), len(found) == 0])
+print(overlapCounts)
@@ -0,0 +1,28 @@
+import os
+import sys
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buildUtils import measuredCall
+
+#A task's recorded peak should not depend on how many tasks its worker
+#has already run.  Each run below leaves an idle child process holding
+#memory behind and grows a per-worker memo, as a reused pool worker
+#would; the peak measured for the identical task must stay flat.
+memo = []
+idle = []
+
+def task(n):
+  scratch = b"x" * (64 * 1024 * 1024)
+  memo.append(b"m" * (16 * 1024 * 1024))
+  idle.append(subprocess.Popen([sys.executable, "-c",
+                                "import sys, time; x = b'i' * (64 * 1024 * 1024); sys.stdin.read()"],
+                               stdin=subprocess.PIPE))
+  return len(scratch)
+
+if __name__ == "__main__":
+  with ProcessPoolExecutor(max_workers=1) as executor:
+    peaks = [executor.submit(measuredCall, task, n).result()[2] for n in range(6)]
+  mb = [round(p / 1024 ** 2) for p in peaks]
+  print("Peak MB per run: " + str(mb))
+  print("Peak independent of prior tasks: " + str(max(mb) - min(mb) <= 16))
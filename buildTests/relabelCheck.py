@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+import pandas as pd
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buildUtils import relabelBytes
+
+#Relabel a real -metaData.json line, as geoMeta writes it with
+#Series.to_json (which escapes "/" as "\/"), from "manual" to "4.0.0".
+old = "manual"
+new = "4.0.0"
+metaInfo = pd.Series({"boundaryID": "IRL-ADM2-" + old + "-G1",
+                      "boundaryISO": "IRL",
+                      "boundaryType": "ADM2",
+                      "downloadURL": ("https://geoboundaries.org/data/geoBoundaries-" + old +
+                                      "/IRL/ADM2/geoBoundaries-" + old + "-IRL-ADM2-all.zip")})
+
+tmpDir = tempfile.mkdtemp()
+src = tmpDir + "/geoBoundaries-" + old + "-IRL-ADM2-metaData.json"
+dst = tmpDir + "/geoBoundaries-" + new + "-IRL-ADM2-metaData.json"
+metaInfo.to_json(src)
+relabelBytes(src, dst, old, new)
+
+with open(src) as f:
+  before = f.read()
+with open(dst) as f:
+  after = f.read()
+print(before)
+print(after)
+expected = metaInfo.str.replace(old, new, regex=False).to_json()
+print("Escaped slash in source: " + str("\\/" in before))
+print("All versions relabeled: " + str(after == expected))
@@ -0,0 +1,583 @@
+#Shared helpers for the geoBoundaries build scripts.
+import os
+import json
+import time
+import heapq
+import random
+import re
+import shutil
+import struct
+import zipfile
+import statistics
+import subprocess
+import atexit
+from collections import OrderedDict
+from concurrent.futures import wait, FIRST_COMPLETED
+
+#Streaming GeoJSON / TopoJSON reading.
+#Release outputs can be far larger than memory once parsed into Python
+#objects, so these helpers decode one array element at a time from a
+#buffered text stream and never hold more than a few features at once.
+def iterJSONArray(path, key="features", chunkSize=1048576, encoding="utf-8"):
+  #Yields each element of the first array stored under key,
+  #e.g. "features" in GeoJSON or "geometries" in TopoJSON.
+  decoder = json.JSONDecoder()
+  opener = re.compile(re.escape('"' + key + '"') + r'\s*:\s*\[')
+  with open(path, 'r', encoding=encoding) as f:
+    buf = ""
+    while True:
+      chunk = f.read(chunkSize)
+      buf = buf + chunk
+      match = opener.search(buf)
+      if(match):
+        buf = buf[match.end():]
+        break
+      if(not chunk):
+        return
+      #Keep enough of the tail to find a key split across chunks.
+      buf = buf[-(len(key) + 256):]
+
+    pos = 0
+    eof = False
+    while True:
+      #Skip separators, reading more if the buffer runs dry.
+      while True:
+        while(pos < len(buf) and buf[pos] in ' \t\r\n,'):
+          pos = pos + 1
+        if(pos < len(buf) or eof):
+          break
+        chunk = f.read(chunkSize)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+      if(pos >= len(buf)):
+        raise ValueError("Unterminated '" + key + "' array in " + path)
+      if(buf[pos] == ']'):
+        return
+
+      try:
+        item, end = decoder.raw_decode(buf, pos)
+      except ValueError:
+        if(eof):
+          raise
+        #The element is incomplete; grow the buffer geometrically so very
+        #large features are not re-parsed once per chunk.
+        chunk = f.read(max(chunkSize, len(buf) - pos))
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+        continue
+
+      yield item
+      pos = end
+      if(pos > chunkSize):
+        buf = buf[pos:]
+        pos = 0
+
+def iterFeatures(path, fields=None, geometry=True, encoding="utf-8"):
+  #Yields GeoJSON features, optionally projected to a subset of
+  #properties and/or without their geometry.
+  for feature in iterJSONArray(path, "features", encoding=encoding):
+    if(fields != None):
+      properties = feature.get("properties") or {}
+      feature["properties"] = {k: properties.get(k) for k in fields}
+    if(not geometry):
+      feature.pop("geometry", None)
+    yield feature
+
+def countJSONArray(path, key="features", encoding="utf-8"):
+  count = 0
+  for item in iterJSONArray(path, key, encoding=encoding):
+    count = count + 1
+  return count
+
+def sampleFeatures(path, n, seed=0, fields=None, geometry=True, encoding="utf-8"):
+  #Uniform reservoir sample of n features in a single pass.
+  rng = random.Random(seed)
+  sample = []
+  for i, feature in enumerate(iterFeatures(path, fields, geometry, encoding)):
+    if(i < n):
+      sample.append(feature)
+    else:
+      j = rng.randint(0, i)
+      if(j < n):
+        sample[j] = feature
+  return sample
+
+#Persistent mapshaper session.
+#Rather than spawning mapshaper-xl for every step, each worker keeps one
+#node process alive (see mapshaperWorker.js) and sends it batches of
+#commands.
+#The build scripts run as __main__, and every task pickled for a pool
+#worker carries its own copy of __main__'s globals, so the registry lives
+#here: tasks reach it by import, and a worker really does reuse one
+#session per heap size across all the tasks it runs.
+class mapshaperSession:
+  "Long-lived mapshaper process that runs batches of commands."
+  def __init__(self, home, heap="8gb"):
+    self.home = home
+    self.heap = heap
+    self.process = None
+    self.used = False
+    self.start()
+
+  def start(self):
+    heapMB = str(int(float(self.heap.lower().replace("gb", "")) * 1024))
+    self.process = subprocess.Popen(["node", "--max-old-space-size=" + heapMB,
+                                     self.home + "/gbRelease/mapshaperWorker.js",
+                                     self.home + "/node_modules/mapshaper"],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    universal_newlines=True, bufsize=1)
+
+  def run(self, commands):
+    #Returns one {"command", "status", "stderr"} dict per command run.
+    #A batch stops at the first failing command.
+    if(isinstance(commands, str)):
+      commands = [commands]
+    self.used = True
+    if(self.process.poll() != None):
+      self.start()
+    try:
+      self.process.stdin.write(json.dumps({"commands": commands}) + "\n")
+      self.process.stdin.flush()
+      response = self.process.stdout.readline()
+      return json.loads(response)["results"]
+    except (OSError, ValueError) as e:
+      #The node process died mid-batch (usually out of memory).
+      self.close()
+      return [{"command": commands[0], "status": 1,
+               "stderr": "mapshaper session terminated: " + str(e)}]
+
+  def close(self):
+    if(self.process != None and self.process.poll() == None):
+      self.process.stdin.close()
+      self.process.wait()
+
+mapshaperSessions = {}
+
+def sharedMapshaperSession(home, heap):
+  if(not heap in mapshaperSessions):
+    mapshaperSessions[heap] = mapshaperSession(home, heap)
+    atexit.register(mapshaperSessions[heap].close)
+  return mapshaperSessions[heap]
+
+#Prepared clip masks by (ISO, clip source hash); see clipMask in
+#buildReleases.py.  Kept here for the same reason as the sessions.
+clipMasks = {}
+
+#Version relabeling.
+#A release promoted from an already-validated build differs only in the
+#version string embedded in IDs, file and layer names and download URLs.
+#These helpers rewrite that string in-stream, file by file, without
+#touching geometry.  The version is only replaced where it appears as an
+#ID/name component: after a dash or a product code and before a dash,
+#slash (or the escaped slash pandas' to_json writes) or extension.
+def versionPattern(version, text=False):
+  pattern = r'(?<=[-A-Z])' + re.escape(version) + r'(?=[-/.\\])'
+  if(text):
+    return re.compile(pattern)
+  return re.compile(pattern.encode("utf-8"))
+
+def relabelBytes(src, dst, oldVersion, newVersion, chunkSize=1048576):
+  #Streams src to dst; a tail the length of the old version is held back
+  #between chunks so matches split across a chunk boundary are not missed.
+  pattern = versionPattern(oldVersion)
+  new = newVersion.encode("utf-8")
+  tail = len(oldVersion.encode("utf-8"))
+  count = 0
+  with open(src, 'rb') as f, open(dst, 'wb') as out:
+    #One byte of already-written context lets the lookbehind see across chunks.
+    context = b""
+    buf = b""
+    while True:
+      chunk = f.read(chunkSize)
+      buf = buf + chunk
+      cut = len(buf) - tail if chunk else len(buf)
+      if(cut <= 0 and chunk):
+        continue
+      data = context + buf
+      cut = cut + len(context)
+      last = len(context)
+      for match in pattern.finditer(data, len(context)):
+        if(match.start() >= cut):
+          break
+        out.write(data[last:match.start()])
+        out.write(new)
+        last = match.end()
+        count = count + 1
+      end = max(last, cut)
+      out.write(data[last:end])
+      context = data[max(end - 1, 0):end]
+      buf = data[end:]
+      if(not chunk):
+        break
+  return count
+
+def relabelDBF(src, dst, oldVersion, newVersion):
+  #Character fields are fixed width; any field a relabeled value no
+  #longer fits in is widened, so the records are rewritten with a new
+  #header.
+  pattern = versionPattern(oldVersion)
+  new = newVersion.encode("utf-8")
+  with open(src, 'rb') as f:
+    header = bytearray(f.read(32))
+    nRecords = struct.unpack('<I', header[4:8])[0]
+    headerLength, recordLength = struct.unpack('<HH', header[8:12])
+    descriptorBlock = f.read(headerLength - 32)
+
+    fields = []
+    pos = 0
+    while(pos + 32 <= len(descriptorBlock) and descriptorBlock[pos] != 0x0D):
+      fields.append(bytearray(descriptorBlock[pos:pos + 32]))
+      pos = pos + 32
+    headerTail = descriptorBlock[pos:]
+    lengths = [d[16] for d in fields]
+    offsets = [1 + sum(lengths[:k]) for k in range(len(lengths))]
+    isChar = [chr(d[11]) == "C" for d in fields]
+
+    #Pass 1: required widths.
+    widths = list(lengths)
+    for r in range(nRecords):
+      record = f.read(recordLength)
+      for k in range(len(fields)):
+        if(isChar[k]):
+          value = record[offsets[k]:offsets[k] + lengths[k]].rstrip(b' ')
+          widths[k] = max(widths[k], len(pattern.sub(new, value)))
+    trailer = f.read()
+
+    if(max(widths + [0]) > 254):
+      raise ValueError(src + ": a relabeled value exceeds the DBF field limit.")
+    for k in range(len(fields)):
+      fields[k][16] = widths[k]
+    newRecordLength = 1 + sum(widths)
+    header[8:12] = struct.pack('<HH', 32 + 32 * len(fields) + len(headerTail), newRecordLength)
+
+    #Pass 2: rewrite records.
+    f.seek(headerLength)
+    with open(dst, 'wb') as out:
+      out.write(bytes(header))
+      for d in fields:
+        out.write(bytes(d))
+      out.write(headerTail)
+      for r in range(nRecords):
+        record = f.read(recordLength)
+        parts = [record[0:1]]
+        for k in range(len(fields)):
+          value = record[offsets[k]:offsets[k] + lengths[k]]
+          if(isChar[k]):
+            value = pattern.sub(new, value.rstrip(b' ')).ljust(widths[k], b' ')
+          parts.append(value)
+        out.write(b"".join(parts))
+      out.write(trailer)
+
+def relabelZip(src, dst, oldVersion, newVersion, citePath):
+  pattern = versionPattern(oldVersion, text=True)
+  workDir = dst + ".members/"
+  os.makedirs(workDir, exist_ok=True)
+  try:
+    with zipfile.ZipFile(src, 'r') as zin, zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED) as zout:
+      for info in zin.infolist():
+        newName = pattern.sub(newVersion, info.filename)
+        if(info.is_dir()):
+          zout.writestr(newName, b"")
+          continue
+        #Previews cannot be relabeled in place; the caller re-renders them
+        #next to the zip first, and those replace the old members.
+        rendered = os.path.join(os.path.dirname(dst), os.path.basename(newName))
+        if(newName.lower().endswith(".png") and os.path.isfile(rendered)):
+          zout.write(rendered, newName)
+          continue
+        memberIn = workDir + "in-" + os.path.basename(info.filename)
+        memberOut = workDir + os.path.basename(newName)
+        with zin.open(info) as m, open(memberIn, 'wb') as out:
+          shutil.copyfileobj(m, out, 1048576)
+        relabelFile(memberIn, memberOut, oldVersion, newVersion, citePath)
+        zout.write(memberOut, newName)
+        os.remove(memberIn)
+        os.remove(memberOut)
+  finally:
+    shutil.rmtree(workDir, ignore_errors=True)
+
+def relabelFile(src, dst, oldVersion, newVersion, citePath):
+  #Dispatch on file type.  Anything else (e.g. a preview the caller does
+  #not re-render) is copied unchanged.
+  name = os.path.basename(src).lower()
+  ext = os.path.splitext(name)[1]
+  if(not os.path.isdir(os.path.dirname(dst))):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+  if("citation-and-use-geoboundaries-" in name):
+    shutil.copyfile(citePath, dst)
+  elif(ext in [".geojson", ".topojson", ".json", ".txt", ".csv"]):
+    relabelBytes(src, dst, oldVersion, newVersion)
+  elif(ext == ".dbf"):
+    relabelDBF(src, dst, oldVersion, newVersion)
+  elif(ext == ".zip"):
+    relabelZip(src, dst, oldVersion, newVersion, citePath)
+  else:
+    shutil.copyfile(src, dst)
+
+#Job cost estimates.
+#Durations from earlier runs are kept per job name in a small JSON file,
+#along with the input size they were measured at.  An estimate scales the
+#last duration by the change in input size; jobs never seen before fall
+#back to their size times the median seconds per byte of the rest.
+class jobCosts:
+  def __init__(self, path):
+    self.path = path
+    self.history = {}
+    if(os.path.isfile(path)):
+      try:
+        with open(path) as f:
+          self.history = json.load(f)
+      except:
+        self.history = {}
+    rates = [h["seconds"] / h["size"] for h in self.history.values() if h.get("size", 0) > 0]
+    seconds = [h["seconds"] for h in self.history.values()]
+    self.rate = statistics.median(rates) if len(rates) > 0 else None
+    self.typical = statistics.median(seconds) if len(seconds) > 0 else None
+    memRates = [h["peak"] / h["size"] for h in self.history.values() if h.get("size", 0) > 0 and h.get("peak")]
+    self.memRate = statistics.median(memRates) if len(memRates) > 0 else None
+
+  def estimate(self, name, size=0):
+    h = self.history.get(name)
+    if(h != None):
+      if(size > 0 and h.get("size", 0) > 0):
+        return h["seconds"] * size / h["size"]
+      return h["seconds"]
+    if(size > 0):
+      if(self.rate != None):
+        return size * self.rate
+      return float(size)
+    if(self.typical != None):
+      return self.typical
+    return 0.0
+
+  def estimateMemory(self, name, size=0):
+    #Peak RSS in bytes.  Unmeasured jobs assume a zip expands roughly
+    #twentyfold once decompressed and parsed, on top of a fixed baseline.
+    h = self.history.get(name)
+    if(h != None and h.get("peak")):
+      if(size > 0 and h.get("size", 0) > 0):
+        return max(h["peak"] * size / h["size"], baselineMemory)
+      return h["peak"]
+    if(size > 0 and self.memRate != None):
+      return max(size * self.memRate, baselineMemory)
+    return baselineMemory + size * 20
+
+  def record(self, name, seconds, size=0, peak=None):
+    self.history[name] = {"seconds": round(seconds, 3), "size": size}
+    if(peak):
+      self.history[name]["peak"] = peak
+
+  def save(self):
+    tmpPath = self.path + ".tmp"
+    with open(tmpPath, 'w') as f:
+      json.dump(self.history, f)
+    os.replace(tmpPath, self.path)
+
+#Memory accounting.
+#The budget comes from gbMemoryBudget (e.g. "48gb") or, failing that, a
+#fraction of MemAvailable.  Peak RSS is read from VmHWM for the worker and
+#the mapshaper sessions a task uses; writing 5 to clear_refs resets the
+#high-water mark so a reused worker reports the peak of the current task
+#only.
+#A session keeps whatever heap its last task grew to, which no estimate
+#covers, so after each task any session holding more than
+#gbIdleSessionMemory (default 1gb) is closed and restarted on next use.
+#The scheduler reserves that much per worker, plus the live size of the
+#calling process's own sessions, before admitting tasks.
+baselineMemory = 256 * 1024 * 1024
+
+def parseSize(text):
+  text = str(text).strip().lower()
+  units = {"kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3, "tb": 1024 ** 4}
+  for unit in units:
+    if(text.endswith(unit)):
+      return int(float(text[:-len(unit)]) * units[unit])
+  return int(float(text))
+
+def memoryBudget(fraction=0.9):
+  if(os.environ.get('gbMemoryBudget', "") != ""):
+    return parseSize(os.environ['gbMemoryBudget'])
+  try:
+    with open("/proc/meminfo") as f:
+      for line in f:
+        if(line.startswith("MemAvailable:")):
+          return int(int(line.split()[1]) * 1024 * fraction)
+  except:
+    pass
+  return None
+
+def statusBytes(pid, field):
+  try:
+    with open("/proc/" + str(pid) + "/status") as f:
+      for line in f:
+        if(line.startswith(field + ":")):
+          return int(line.split()[1]) * 1024
+  except:
+    pass
+  return 0
+
+def peakRSS(pid):
+  return statusBytes(pid, "VmHWM")
+
+def currentRSS(pid):
+  return statusBytes(pid, "VmRSS")
+
+def resetPeakRSS(pid):
+  try:
+    with open("/proc/" + str(pid) + "/clear_refs", 'w') as f:
+      f.write("5")
+  except:
+    pass
+
+def idleSessionMemory():
+  return parseSize(os.environ.get('gbIdleSessionMemory', "1gb"))
+
+def sessionMemory():
+  #Live size of this process's mapshaper sessions.
+  return sum(currentRSS(s.process.pid) for s in mapshaperSessions.values()
+             if s.process != None and s.process.poll() == None)
+
+def recycleSessions(limit):
+  for session in mapshaperSessions.values():
+    if(session.process != None and session.process.poll() == None and currentRSS(session.process.pid) > limit):
+      session.close()
+
+def measuredCall(fn, *args):
+  #Like timedCall, plus the task's own peak memory: how far the worker and
+  #any mapshaper session the task ran commands on grew above what they
+  #held when it started.  Idle sessions and memos left by earlier tasks
+  #are not counted, so a task reports the same peak however many tasks
+  #its worker has run before it.
+  pids = [os.getpid()] + [s.process.pid for s in mapshaperSessions.values() if s.process != None]
+  start = {}
+  for pid in pids:
+    resetPeakRSS(pid)
+    start[pid] = currentRSS(pid)
+  for session in mapshaperSessions.values():
+    session.used = False
+  result, seconds = timedCall(fn, *args)
+  pids = [os.getpid()] + [s.process.pid for s in mapshaperSessions.values() if s.used and s.process != None]
+  peak = sum(max(peakRSS(pid) - start.get(pid, 0), 0) for pid in pids)
+  recycleSessions(idleSessionMemory())
+  return result, seconds, peak
+
+def timedCall(fn, *args):
+  #Runs in the worker, so the duration excludes time spent queued.
+  start = time.time()
+  result = fn(*args)
+  return result, time.time() - start
+
+#Dependency-graph scheduling.
+#Each task becomes ready as soon as everything it depends on has finished,
+#instead of waiting for a whole phase to drain.  Ready tasks are handed to
+#the executor longest-path-first: a task's priority is its own estimated
+#cost plus the most expensive chain of tasks waiting on it, so big
+#boundaries and their downstream products start early rather than
+#trailing at the end of the run.  A task fails if it raises or returns
+#False; tasks with a hard dependency (deps) on a failed or skipped task
+#are skipped, while ordering-only dependencies (after) just wait for it to
+#finish.  Dependencies on names that are not in the graph are ignored.
+#Given a memoryBudget, a task is only admitted while the estimated memory
+#of everything running plus its own fits; if the next task in line does
+#not fit, nothing behind it jumps the queue, so large tasks are not
+#starved.  A task that exceeds the budget on its own runs alone.  Memory
+#the tasks do not account for (idle sessions in each worker, and in the
+#calling process) is taken off the budget first.
+class taskGraph:
+  def __init__(self):
+    self.tasks = OrderedDict()
+    self.durations = {}
+    self.peaks = {}
+
+  def add(self, name, fn, args=(), deps=[], after=[], cost=0, memory=0):
+    self.tasks[name] = {"fn": fn, "args": args, "deps": list(deps), "after": list(after),
+                        "cost": cost, "memory": memory}
+
+  def run(self, executor, maxRunning=None, memoryBudget=None, verbose=True):
+    status = {}
+    running = {}
+    waiting = {}
+    dependents = {}
+    ready = []
+    for name in self.tasks:
+      parents = set(d for d in self.tasks[name]["deps"] + self.tasks[name]["after"] if d in self.tasks)
+      waiting[name] = len(parents)
+      for parent in parents:
+        dependents.setdefault(parent, []).append(name)
+
+    priority = {}
+    def rank(name):
+      if(name not in priority):
+        priority[name] = None
+        below = [rank(child) for child in dependents.get(name, [])]
+        priority[name] = self.tasks[name]["cost"] + max([b for b in below if b != None] + [0])
+      return priority[name]
+    for name in self.tasks:
+      rank(name)
+
+    order = dict((name, i) for i, name in enumerate(self.tasks))
+    def enqueue(name):
+      heapq.heappush(ready, (-priority[name], order[name], name))
+
+    workers = maxRunning if maxRunning != None else getattr(executor, "_max_workers", 1)
+    def fits(name):
+      if((memoryBudget == None) or (len(running) == 0)):
+        return True
+      idle = workers * idleSessionMemory() + sessionMemory()
+      inUse = sum(self.tasks[n]["memory"] for n in running.values())
+      return (idle + inUse + self.tasks[name]["memory"]) <= memoryBudget
+
+    def fill():
+      while(len(ready) > 0 and ((maxRunning == None) or (len(running) < maxRunning))):
+        if(not fits(ready[0][2])):
+          break
+        name = heapq.heappop(ready)[2]
+        task = self.tasks[name]
+        running[executor.submit(measuredCall, task["fn"], *task["args"])] = name
+
+    def release(name):
+      for child in dependents.get(name, []):
+        if(child in status):
+          continue
+        if((status[name] != "done") and (name in self.tasks[child]["deps"])):
+          status[child] = "skipped"
+          if(verbose):
+            print(child + " skipped: " + name + " " + status[name] + ".")
+          release(child)
+        else:
+          waiting[child] = waiting[child] - 1
+          if(waiting[child] == 0):
+            enqueue(child)
+
+    for name in self.tasks:
+      if(waiting[name] == 0):
+        enqueue(name)
+    fill()
+
+    while(len(running) > 0):
+      finished, pending = wait(list(running), return_when=FIRST_COMPLETED)
+      for future in finished:
+        name = running.pop(future)
+        try:
+          result, seconds, peak = future.result()
+          self.durations[name] = seconds
+          self.peaks[name] = peak
+          ok = (result is not False)
+        except Exception as e:
+          ok = False
+          if(verbose):
+            print(name + " raised: " + repr(e))
+        status[name] = "done" if ok else "failed"
+        if(verbose):
+          print(name + " " + status[name] + " (" + str(len(status)) + " of " + str(len(self.tasks)) + ")")
+        release(name)
+      fill()
+
+    #Anything left never became ready (a dependency cycle).
+    for name in self.tasks:
+      if(name not in status):
+        status[name] = "skipped"
+    return status
@@ -0,0 +1,70 @@
+// Long-lived mapshaper worker used by buildReleases.py (mapshaperSession).
+// Reads one JSON request per line on stdin:
+//   {"commands": ["-i a.topojson -o b.topojson", ...]}
+// and answers each with one JSON line on stdout:
+//   {"results": [{"command": "...", "status": 0, "stderr": "..."}, ...]}
+// Commands run in order and a batch stops at the first failure; outputs
+// are written to disk as each command finishes.
+var fs = require('fs');
+var path = require('path');
+var readline = require('readline');
+var mapshaper = require(process.argv[2]);
+
+var messages = [];
+var reply = process.stdout.write.bind(process.stdout);
+
+// mapshaper reports progress and errors through the console.
+console.log = console.error = console.warn = function() {
+  messages.push(Array.prototype.join.call(arguments, ' '));
+};
+
+function runCommand(command) {
+  return new Promise(function(resolve) {
+    messages = [];
+    mapshaper.applyCommands(command, {}, function(err, output) {
+      var status = 0;
+      if (err) {
+        status = 1;
+        messages.push(String(err.message || err));
+      } else {
+        Object.keys(output || {}).forEach(function(name) {
+          var outPath = path.resolve(name);
+          fs.mkdirSync(path.dirname(outPath), {recursive: true});
+          fs.writeFileSync(outPath, output[name]);
+        });
+      }
+      resolve({command: command, status: status, stderr: messages.join('\n')});
+    });
+  });
+}
+
+async function runBatch(request) {
+  var results = [];
+  for (var i = 0; i < request.commands.length; i++) {
+    var result = await runCommand(request.commands[i]);
+    results.push(result);
+    if (result.status !== 0) break;
+  }
+  return results;
+}
+
+// Pool workers exit without running Python's atexit hooks, so the session
+// also ends itself once its stdin closes and the queued batches finish.
+var queue = Promise.resolve();
+var input = readline.createInterface({input: process.stdin});
+input.on('close', function() {
+  queue.then(function() { process.exit(0); });
+});
+input.on('line', function(line) {
+  queue = queue.then(function() {
+    var request;
+    try {
+      request = JSON.parse(line);
+    } catch (e) {
+      return reply(JSON.stringify({results: [{command: line, status: 1, stderr: String(e)}]}) + '\n');
+    }
+    return runBatch(request).then(function(results) {
+      reply(JSON.stringify({results: results}) + '\n');
+    });
+  });
+});